@@ -0,0 +1,5 @@
+from ISS_common.files import (FILE_NAMING_PATTERNS,
+                              build_file_catalogue,
+                              index_catalogue)
+from ISS_common.czi import (czi_tile_positions,
+                            write_czi_export_xml)
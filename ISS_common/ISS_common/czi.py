@@ -0,0 +1,55 @@
+"""Tile positions and ZEN export XML of CZI mosaics, shared by process_czi and deconvolve_czi"""
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+def czi_tile_positions(czi, msize):
+    """
+    Read the x and y of the upper left corner of every mosaic tile of a CZI file.
+
+    The bounding boxes are the same for every channel and z-plane, so they are read once per tile,
+    in a single call where the installed aicspylibczi has get_all_mosaic_tile_bounding_boxes.
+
+    Returns:
+    - Arrays of the x and y positions, indexed by mosaic tile.
+    """
+    x = np.zeros(msize, dtype=int)
+    y = np.zeros(msize, dtype=int)
+    found = np.zeros(msize, dtype=bool)
+    if hasattr(czi, 'get_all_mosaic_tile_bounding_boxes'):
+        for tile_info, bbox in czi.get_all_mosaic_tile_bounding_boxes(C=0, Z=0).items():
+            m = tile_info.m_index
+            if 0 <= m < msize and not found[m]:
+                x[m], y[m], found[m] = bbox.x, bbox.y, True
+    for m in np.flatnonzero(~found):
+        bbox = czi.get_mosaic_tile_bounding_box(M=int(m), Z=0, C=0)
+        x[m], y[m] = bbox.x, bbox.y
+    return x, y
+
+
+def write_czi_export_xml(output_file, filenames, tile_index, channel_index, x, y, tile_size_x, tile_size_y):
+    """
+    Write the ZEN ExportDocument XML of exported CZI tiles, sorted by channel and tile.
+
+    Parameters:
+    - output_file: Path of the XML file.
+    - filenames, tile_index, channel_index, x, y: One entry per exported image.
+      x and y are the tile positions, written relative to the top-left tile.
+    - tile_size_x, tile_size_y: Size of the tiles.
+    """
+    x = np.asarray(x) - np.min(x)
+    y = np.asarray(y) - np.min(y)
+    order = np.lexsort((tile_index, channel_index))
+
+    export_doc = ET.Element('ExportDocument')
+    for filename, start_x, start_y, m in zip(np.asarray(filenames)[order].tolist(), x[order].tolist(),
+                                             y[order].tolist(), np.asarray(tile_index)[order].tolist()):
+        image_elem = ET.SubElement(export_doc, 'Image')
+        ET.SubElement(image_elem, 'Filename').text = filename
+        ET.SubElement(image_elem, 'Bounds', StartX=str(start_x), SizeX=str(tile_size_x), StartY=str(start_y),
+                      SizeY=str(tile_size_y), StartZ='0', StartC='0', StartM=str(m))
+        ET.SubElement(image_elem, 'Zoom').text = '1'
+
+    with open(output_file, 'wb') as f:
+        f.write(ET.tostring(export_doc))
@@ -0,0 +1,63 @@
+"""Parsing of the microscope and pipeline file names, shared by ISS_processing and ISS_deconvolution
+
+Both packages index their directories with the same catalogue, so the keys (region, tile, channel)
+mean the same thing everywhere: the strings found in the file names, e.g. tile '001', channel 'C00'.
+"""
+import os
+
+import pandas as pd
+
+
+FILE_NAMING_PATTERNS = {
+    # Leica autosave: "<region>--Stage<tile>--Z<z>--C<channel>.tif"
+    'autosaved': r'^(?P<region>.+?)--Stage(?P<tile>\d+)(?:--Z(?P<z>\d+))?.*?--(?P<channel>C\d+)\.tiff?$',
+    # LasX export: "<region>_s<tile>_z<z>_ch<channel>.tif"
+    'exported': r'^(?P<region>.+?)_s(?P<tile>\d+)(?:_z(?P<z>\d+))?.*?_(?P<channel>ch\d+)\.tiff?$',
+    # Projected tiles from leica_mipping, lif_mipping and the deconvolution module: "Base_<base>_s<tile>_<channel>.tif"
+    'mipped': r'^Base_(?P<base>\d+)_s(?P<tile>\d+)_(?P<channel>[^_]+?)\.tiff?$',
+    # Projected tiles from process_czi and deconvolve_czi: "Base_<base>_c<channel>m<tile>_ORG.tif"
+    'zen': r'^Base_(?P<base>\d+)_c(?P<channel>\d+)m(?P<tile>\d+).*\.tiff?$',
+}
+
+
+def build_file_catalogue(directory, naming, files=None):
+    """
+    Parse the image file names of a directory into a catalogue, in a single regex pass.
+
+    Parameters:
+    - directory: Directory to list.
+    - naming: Key of FILE_NAMING_PATTERNS ('autosaved', 'exported', 'mipped' or 'zen').
+    - files: Optional pre-filtered list of file names. If None, the directory is listed.
+
+    Returns:
+    - DataFrame with a 'file' column plus one column per field of the naming pattern
+      (region, tile, channel, z, base). Tiles and channels are kept as the strings found
+      in the file name (e.g. '001' and 'C00' or 'ch00'), z is an integer. Files that do not
+      follow the naming are dropped.
+    """
+    if files is None:
+        files = os.listdir(directory) if os.path.exists(directory) else []
+    files = pd.Series([f for f in files if not f.startswith('._')], dtype=object)
+    catalogue = files.str.extract(FILE_NAMING_PATTERNS[naming])
+    catalogue.insert(0, 'file', files)
+    catalogue = catalogue.dropna(subset=['tile', 'channel'])
+    if 'z' in catalogue:
+        catalogue['z'] = pd.to_numeric(catalogue['z']).fillna(0).astype(int)
+    return catalogue.reset_index(drop=True)
+
+
+def index_catalogue(catalogue, keys):
+    """
+    Group a file catalogue into a dictionary for O(1) lookups.
+
+    Parameters:
+    - catalogue: DataFrame returned by build_file_catalogue.
+    - keys: List of catalogue columns to index on, e.g. ['region', 'tile', 'channel'].
+
+    Returns:
+    - Dictionary mapping tuples of key values to the list of matching file names, ordered by z.
+    """
+    if 'z' in catalogue:
+        catalogue = catalogue.sort_values('z', kind='stable')
+    return {key: list(group['file']) for key, group in catalogue.groupby(keys, sort=False)}
+
@@ -0,0 +1,37 @@
+from setuptools import setup, find_packages
+import codecs
+import os
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+with codecs.open(os.path.join(here, "README.md"), encoding="utf-8") as fh:
+    long_description = "\n" + fh.read()
+
+VERSION = '0.0.0'
+DESCRIPTION = 'File naming and metadata helpers shared by the ISS packages'
+LONG_DESCRIPTION = 'This package holds the helpers used by both ISS_processing and ISS_deconvolution to parse the microscope file names. It only depends on numpy and pandas, so it can be installed in every environment.'
+
+# Setting up
+setup(
+    name="ISS_common",
+    version=VERSION,
+    author="Marco Grillo",
+    author_email="<marco.grillo@scilifelab.se>",
+    description=DESCRIPTION,
+    long_description_content_type="text/markdown",
+    long_description=long_description,
+    packages=find_packages(),
+    install_requires=['numpy', 'pandas'],
+    keywords=['python', 'spatial transcriptomics', 
+            'spatial resolved transcriptomics', 
+            'in situ sequencing', 
+            'ISS'],
+    classifiers=[
+        "Development Status :: 1 - Planning",
+        "Intended Audience :: Researchers",
+        "Programming Language :: Python :: 3",
+        "Operating System :: Unix",
+        "Operating System :: MacOS :: MacOS X",
+        "Operating System :: Microsoft :: Windows",
+    ]
+)
@@ -72,7 +72,15 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
                                     channels = ["DAPI", "Cy3", "Cy5", "AF750", "AF488"],
                                     DO_decorators = ["AF750", "Cy5", "Cy3", "AF488"],
                                     folder_spacetx = 'SpaceTX_format', 
-                                    nuclei_channel = 1):
+                                    nuclei_channel = 1,
+                                    tile_format = 'tif'):
+    """
+    Write the ISS experiment in SpaceTx format from the retiled stitched images in <path>/preprocessing/ReslicedTiles.
+
+    tile_format is 'tif' (default) to read the tile<k>.tif files, or 'zarr' to read the tiles.zarr
+    store written by tile_stitched_images(output_format='zarr'). With 'zarr' the tiles are cut
+    from the store with the given tile_dim, which does not have to be the tile_dim of the store.
+    """
 
     class ISSTile2D(FetchedTile):
         def __init__(self, file_path, fov):
@@ -95,6 +103,21 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
             return imread(self.file_path)
 
 
+    class ISSZarrTile2D(ISSTile2D):
+        def __init__(self, array, r, ch, fov):
+            self.array = array
+            self.r = r
+            self.ch = ch
+            self.fov = fov
+
+        def tile_data(self) -> np.ndarray:
+            x, y = tilexy[self.fov].astype(int)
+            tile = np.zeros((tilesz, tilesz), dtype=self.array.dtype)
+            data = self.array[self.r, self.ch, y:y + tilesz, x:x + tilesz]
+            tile[:data.shape[0], :data.shape[1]] = data
+            return tile
+
+
     class ISS2DPrimaryTileFetcher(TileFetcher):
         def __init__(self, path):
             self.path = path
@@ -111,6 +134,26 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
             #return ISSTile2D(os.path.join(self.path, self.prefix + "{}.tif".format(fov+1)), fov)
             return ISSTile2D(os.path.join(self.path, "{}-{}/tile{}.tif".format(filenames[r], nuclei_channel ,fov+1)), fov)
 
+
+    class ISS2DPrimaryZarrTileFetcher(TileFetcher):
+        def __init__(self, store):
+            self.store = store
+
+        def get_tile(self, fov: int, r: int, ch: int, z: int) -> FetchedTile:
+            tiles = self.store.attrs['tiles']
+            return ISSZarrTile2D(self.store['0'], tiles['rounds'].index(filenames[r]),
+                                 tiles['channels'].index(CHORDER[ch]+1), fov)
+
+
+    class ISS2DAuxZarrTileFetcher(TileFetcher):
+        def __init__(self, store):
+            self.store = store
+
+        def get_tile(self, fov: int, r: int, ch: int, z: int) -> FetchedTile:
+            tiles = self.store.attrs['tiles']
+            return ISSZarrTile2D(self.store['0'], tiles['rounds'].index(filenames[r]),
+                                 tiles['channels'].index(nuclei_channel), fov)
+
     
     CHORDER = [channels.index(i) for i in DO_decorators]
 
@@ -118,7 +161,6 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
 
     tilesz = tile_dim 
     SHAPE = {Axes.Y: tilesz, Axes.X: tilesz}
-    num_tiles = len(os.listdir(path+'/preprocessing/ReslicedTiles/Base_1_stitched-1'))
 
     input_dir = path +'/preprocessing/ReslicedTiles'
     output_dir = path + '/' +folder_spacetx
@@ -129,7 +171,21 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
         except:
             os.makedirs(output_dir)
 
-    tilexy = get_tilepos(tilepos_xy_csv)
+    if tile_format == 'zarr':
+        import zarr
+        store = zarr.open_group(input_dir + '/tiles.zarr', mode='r')
+        # same row by row tile order as tile_stitched_images, for this tile_dim
+        image_shape = store.attrs['tiles']['shape']
+        ys, xs = np.meshgrid(np.arange(0, image_shape[0], tilesz), np.arange(0, image_shape[1], tilesz), indexing='ij')
+        tilexy = np.column_stack([xs.ravel(), ys.ravel()]).astype(np.double)
+        num_tiles = len(tilexy)
+        primary_tile_fetcher = ISS2DPrimaryZarrTileFetcher(store)
+        aux_tile_fetcher = ISS2DAuxZarrTileFetcher(store)
+    else:
+        num_tiles = len(os.listdir(path+'/preprocessing/ReslicedTiles/Base_1_stitched-1'))
+        tilexy = get_tilepos(tilepos_xy_csv)
+        primary_tile_fetcher = ISS2DPrimaryTileFetcher(input_dir)
+        aux_tile_fetcher = ISS2DAuxTileFetcher(input_dir)
 
 
     write_experiment_json(
@@ -146,9 +202,9 @@ def make_spacetx_format(path, codebook_csv,filenames = ['Base_1_stitched',
                 Axes.ZPLANE: 1,
             },
         },
-        primary_tile_fetcher=ISS2DPrimaryTileFetcher(input_dir),
+        primary_tile_fetcher=primary_tile_fetcher,
         aux_tile_fetcher={
-            'nuclei': ISS2DAuxTileFetcher(input_dir),
+            'nuclei': aux_tile_fetcher,
         },
         postprocess_func=add_codebook,
         default_shape=SHAPE
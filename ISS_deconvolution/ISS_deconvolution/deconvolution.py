@@ -7,6 +7,8 @@ import shutil
 import subprocess
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # --- Third-Party Libraries ---
 import numpy as np
@@ -21,6 +23,9 @@ from readlif.reader import LifFile
 # --- Custom Modules ---
 import RedLionfishDeconv as rl
 import ISS_deconvolution.psf as fd_psf
+from ISS_common.czi import czi_tile_positions, write_czi_export_xml
+from ISS_common.files import build_file_catalogue, index_catalogue
+from ISS_deconvolution.richardson_lucy import RichardsonLucy
 
 
 
@@ -56,7 +61,7 @@ def custom_copy(src, dest):
     if os.path.isdir(dest):
         dest = os.path.join(dest, os.path.basename(src))
     shutil.copyfile(src, dest)
-    
+
 
 def generate_psf(psf_output, resxy, resz, wavelength, NA, ni):
     # dw_bw command to generate PSF
@@ -78,7 +83,7 @@ def generate_psf(psf_output, resxy, resz, wavelength, NA, ni):
         print(f"Error generating PSF: {e}")
 
 
-def deconvolve_image(input_image, psf_image, output_image, iterations, tilesize=None):
+def deconvolve_image(input_image, psf_image, output_image, iterations, tilesize=None, relerror=None):
     # DeconWolf command to deconvolve the image
 
     command = [
@@ -90,7 +95,11 @@ def deconvolve_image(input_image, psf_image, output_image, iterations, tilesize=
     ]
 
     if tilesize is not None:
-        command += ['--tilesize', str(tilesize)]
+        # deconwolf takes the largest side of its tiles, chunk_size may be given as [x, y]
+        command += ['--tilesize', str(int(np.max(tilesize)))]
+
+    if relerror is not None:
+        command += ['--relerror', str(relerror)]
     
     try:
         # Run the command
@@ -108,11 +117,82 @@ def deconvolve_image(input_image, psf_image, output_image, iterations, tilesize=
     
 
 
+def psf_halo(psf, energy=0.999):
+    """
+    Halo (pixels) for deconvolve_blocks: the half-width of the smallest centered XY square that
+    carries the given fraction of the energy of a [z, y, x] PSF over all z-slices.
+    """
+    projection = np.asarray(psf, dtype=np.float64).sum(axis=0)
+    y, x = np.indices(projection.shape)
+    distance = np.maximum(np.abs(y - projection.shape[0] // 2), np.abs(x - projection.shape[1] // 2))
+    square_energy = np.cumsum(np.bincount(distance.ravel(), weights=projection.ravel()))
+    return int(np.searchsorted(square_energy, energy * square_energy[-1])) + 1
+
+
+def deconvolve_blocks(image, deconvolve, block_size, halo, n_workers=1):
+    """
+    Deconvolve a [z, y, x] stack block by block, so that peak memory is bounded by the block size
+    for any deconvolution method.
+
+    The stack is split into XY blocks of block_size, each read with a halo of its neighbours' pixels
+    so that the PSF sees real data around it. Neighbouring blocks overlap by 2 * halo, where they are
+    blended with linear ramps that sum to one, hiding the seams and the block edge artefacts.
+
+    Parameters:
+    - image: [z, y, x] stack.
+    - deconvolve: Function deconvolving a [z, y, x] block into an array of the same shape, e.g.
+                  RichardsonLucy(psf).run or partial(rl.doRLDeconvolutionFromNpArrays, psf_np=psf).
+    - block_size: [x, y] size of the blocks without the halo, or an int for square blocks.
+    - halo: Pixels read around every block, e.g. psf_halo(psf).
+    - n_workers: Number of blocks deconvolved at once in threads. deconvolve must be thread-safe
+                 if > 1 (RichardsonLucy is).
+
+    Returns:
+    The deconvolved float32 stack.
+    """
+    size_y, size_x = image.shape[1:]
+    block_x, block_y = (block_size, block_size) if np.isscalar(block_size) else block_size
+    halo = int(halo)
+
+    def window(start, block, size):
+        # Read window of a block along one axis and its blending weights
+        lower, upper = max(start - halo, 0), min(start + block + halo, size)
+        weight = np.ones(upper - lower, dtype=np.float32)
+        if halo:
+            ramp = (np.arange(upper - lower, dtype=np.float32) + 0.5) / (2 * halo)
+            if lower > 0:
+                weight = np.minimum(weight, ramp)
+            if upper < size:
+                weight = np.minimum(weight, ramp[::-1])
+        return slice(lower, upper), weight
+
+    blocks = [(window(y, block_y, size_y), window(x, block_x, size_x))
+              for y in range(0, size_y, block_y) for x in range(0, size_x, block_x)]
+
+    def run(block):
+        (rows, _), (cols, _) = block
+        return deconvolve(np.ascontiguousarray(image[:, rows, cols]))
+
+    output = np.zeros(image.shape, dtype=np.float32)
+    weights = np.zeros((size_y, size_x), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # Submit n_workers blocks at a time to keep only that many results in memory
+        for i in range(0, len(blocks), n_workers):
+            batch = blocks[i:i + n_workers]
+            for ((rows, weight_y), (cols, weight_x)), result in zip(batch, pool.map(run, batch)):
+                weight = np.outer(weight_y, weight_x)
+                output[:, rows, cols] += result * weight
+                weights[rows, cols] += weight
+    output /= weights
+    return output
+
+
 # -------------------------------------------------------------------------------------
 # CZI
 # -------------------------------------------------------------------------------------
 
-def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metadata=None, chunk_size=None,  mip=True, cycle=0, tile_size_x=2048, tile_size_y=2048):
+def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metadata=None, chunk_size=None,  mip=True, cycle=0, tile_size_x=2048, tile_size_y=2048,
+                   psf_energy=None):
 
     """
     Process CZI files, deconvolve the image stacks, apply maximum intensity projection (if specified), 
@@ -121,24 +201,21 @@ def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metad
     Parameters:
     - input_file: Path to the input CZI file.
     - outpath: Directory where the processed images and XML will be saved.
-    - chunk_size= [x,y] where x and y are the size of the chunks the image needs to be cut into for small GPU processing
+    - chunk_size= [x,y] where x and y are the size of the chunks the image needs to be cut into for small GPU processing,
+                  see deconvolve_blocks.
     - mip: Boolean to decide whether to apply maximum intensity projection. Default is True.
     - cycle: Int to specify the cycle number. Default is 0.
     - tile_size_x: Size of the tile in X dimension. Default is 2048.
     - tile_size_y: Size of the tile in Y dimension. Default is 2048.
+    - psf_energy: Optional fraction of the PSF energy, e.g. 0.999. The PSF is then generated only over the
+                  window that carries it instead of over the whole tile, see GibsonLanni.generate.
     
     Returns:
     - A string indicating that processing is complete.
     """
 
-    def cropND(img, bounding):
-        start = tuple(map(lambda a, da: a//2-da//2, img.shape, bounding))
-        end = tuple(map(lambda a, da: a+da, start, bounding))
-        slices = tuple(map(slice, start, end))
-        return img[slices]
-
     # Load the CZI file and retrieve its dimensions.
-    czi = aicspylibczi.CziFile(input_file)
+    czi = CziFile(input_file)
     dimensions = czi.get_dims_shape() 
     chsize = dimensions[0]['C'][1]
     msize = dimensions[0]['M'][1]
@@ -150,8 +227,8 @@ def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metad
     
     # Check if mip is and cycle is not zero.
     if cycle != 0:
-        Bxcoord = []
-        Bycoord = []
+        # Tile positions, read once per tile for all channels.
+        tile_x, tile_y = czi_tile_positions(czi, msize)
         Btile_index = []
         filenamesxml = []
         Bchindex = []
@@ -168,7 +245,7 @@ def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metad
                 size_x=tile_size_x,
                 size_y=tile_size_y,
                 size_z=z_size  # Use the Z dimension from the CZI file
-            ).generate()
+            ).generate_cached(energy=psf_energy)
 
         # Process each channel and mosaic tile
         for m in tqdm(range(0, msize)):
@@ -177,41 +254,26 @@ def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metad
                 img, shp = czi.read_image(M=m, C=ch)
                 img=np.squeeze(img, axis=(0,1,2,4))
                 
-                # Read metadata for the current mosaic tile and channel
 
-                meta = czi.get_mosaic_tile_bounding_box(M=m, Z=0, C=ch)
-           
-
-                # Instantiate the Richardson-Lucy deconvolution algorithm
-                algo = RichardsonLucyDeconvolver(img.ndim, pad_mode="2357", pad_min=(6,6,6))
+                # Richardson-Lucy deconvolution with RedLionfish
+                deconvolve = partial(rl.doRLDeconvolutionFromNpArrays, psf_np=psf_dict[ch], niter=50)
 
                 # Check if chunk_size is provided
                 if chunk_size:
-                    # Define chunk dimensions
-                    chunked_dims = (z_size, chunk_size[0], chunk_size[1])
-
-                    # Convert image data to a chunked dask array
-                    arr = da.from_array(img, chunks=chunked_dims)
-                    cropped_kernel = cropND(psf_dict[ch], chunked_dims)
-
-                    # Define deconvolution function for chunks
-                    def deconv(chunk):
-                        tmp = algo.initialize().run(fd_data.Acquisition(data=chunk, kernel=cropped_kernel), 50)
-                        return tmp.data 
-
-                    # Apply chunked deconvolution
-                    deconvolved = arr.map_overlap(deconv, depth=(6,6,6), boundary='reflect', dtype='uint16').compute(num_workers=1)
+                    # Deconvolve chunks with a halo carrying the PSF energy, blended at the seams
+                    deconvolved = deconvolve_blocks(img, deconvolve, chunk_size,
+                                                    psf_halo(psf_dict[ch], psf_energy or 0.999))
                 else:
                     # Regular deconvolution for the entire image
-                    deconvolved = algo.initialize().run(fd_data.Acquisition(data=img, kernel=psf_dict[ch]), 50)
+                    deconvolved = deconvolve(img)
                 if chsize != len(PSF_metadata['channels']):
                     raise ValueError("Mismatch between CZI file channels and PSF_metadata channels.")
                 #print(deconvolved.data.shape)
                 # Check if mip (max intensity projection) is enabled
                 if mip:
-                    processed_img = np.max(deconvolved.data, axis=0).astype('uint16')
+                    processed_img = np.max(deconvolved, axis=0).astype('uint16')
                 else:
-                    processed_img = deconvolved.data.astype('uint16')
+                    processed_img = deconvolved.astype('uint16')
             
                 # Construct filename for the processed image
                 n = str(0)+str(m+1) if m < 9 else str(m+1)
@@ -219,54 +281,14 @@ def deconvolve_czi(input_file, outpath, image_dimensions=[2048, 2048], PSF_metad
 
                 # Save the processed image
                 tifffile.imwrite(os.path.join(outpath, filename), processed_img)
-            # Append metadata to the placeholders.
-            Bchindex.append(ch)
-            Bxcoord.append(meta.x)
-            Bycoord.append(meta.y)
-            Btile_index.append(m)
-            filenamesxml.append(filename)
- # Adjust the XY coordinates to be relative.
-        nBxcord = [x - min(Bxcoord) for x in Bxcoord]
-        nBycord = [y - min(Bycoord) for y in Bycoord]
-        
-        # Create a DataFrame to organize the collected metadata.
-        metadatalist = pd.DataFrame({
-            'Btile_index': Btile_index, 
-            'Bxcoord': nBxcord, 
-            'Bycoord': nBycord, 
-            'filenamesxml': filenamesxml,
-            'channelindex': Bchindex
-        })
-        
-        metadatalist = metadatalist.sort_values(by=['channelindex','Btile_index'])
-        metadatalist.reset_index(drop=True)
-
-        # Initialize the XML document structure.
-        export_doc = ET.Element('ExportDocument')
-        
-        # Populate the XML document with metadata.
-        for index, row in metadatalist.iterrows():
-            image_elem = ET.SubElement(export_doc, 'Image')
-            filename_elem = ET.SubElement(image_elem, 'Filename')
-            filename_elem.text = row['filenamesxml']
-            
-            bounds_elem = ET.SubElement(image_elem, 'Bounds')
-            bounds_elem.set('StartX', str(row['Bxcoord']))
-            bounds_elem.set('SizeX', str(tile_size_x))
-            bounds_elem.set('StartY', str(row['Bycoord']))
-            bounds_elem.set('SizeY', str(tile_size_y))
-            bounds_elem.set('StartZ', '0')
-            bounds_elem.set('StartC', '0')
-            bounds_elem.set('StartM', str(row['Btile_index']))
-            
-            zoom_elem = ET.SubElement(image_elem, 'Zoom')
-            zoom_elem.text = '1'
+                # Append metadata to the placeholders.
+                Bchindex.append(ch)
+                Btile_index.append(m)
+                filenamesxml.append(filename)
 
-        
-        # Save the constructed XML document to a file.
-        xml_str = ET.tostring(export_doc)
-        with open(outpath + 'Base_' + str(cycle) + '_info.xml', 'wb') as f:
-            f.write(xml_str)
+        # Save the ExportDocument XML, with XY coordinates relative to the top-left tile.
+        write_czi_export_xml(outpath + 'Base_' + str(cycle) + '_info.xml', filenamesxml, Btile_index, Bchindex,
+                             tile_x[Btile_index], tile_y[Btile_index], tile_size_x, tile_size_y)
   
     return "Processing complete."
     
@@ -279,7 +301,12 @@ def deconvolve_leica(input_dir,
                      mode='tif_autosaved',
                      mip=True,
                      image_dimensions=[2048, 2048],
-                     chunk_size=None):
+                     chunk_size=None,
+                     psf_energy=None,
+                     niter=None,
+                     accelerate=False,
+                     tol=None,
+                     block_workers=1):
 
     valid_modes = {'tif_autosaved', 'tif_exported', 'lif'}
 
@@ -295,7 +322,12 @@ def deconvolve_leica(input_dir,
                        mip=mip,
                        image_dimensions=image_dimensions,
                        chunk_size=chunk_size,
-                       mode='autosaved')
+                       mode='autosaved',
+                       psf_energy=psf_energy,
+                       niter=niter,
+                       accelerate=accelerate,
+                       tol=tol,
+                       block_workers=block_workers)
 
     elif mode == 'tif_exported':
         deconvolve_tif(input_dir=input_dir, 
@@ -306,7 +338,12 @@ def deconvolve_leica(input_dir,
                        mip=mip,
                        image_dimensions=image_dimensions,
                        chunk_size=chunk_size,
-                       mode='exported')
+                       mode='exported',
+                       psf_energy=psf_energy,
+                       niter=niter,
+                       accelerate=accelerate,
+                       tol=tol,
+                       block_workers=block_workers)
 
     elif mode == 'lif':
         deconvolve_lif(input_dir=input_dir, 
@@ -316,7 +353,12 @@ def deconvolve_leica(input_dir,
                        PSF_metadata=PSF_metadata, 
                        mip=mip,
                        image_dimensions=image_dimensions,
-                       chunk_size=chunk_size)
+                       chunk_size=chunk_size,
+                       psf_energy=psf_energy,
+                       niter=niter,
+                       accelerate=accelerate,
+                       tol=tol,
+                       block_workers=block_workers)
 
 # -------------------------------------------------------------------------------------
 # LEICA EXPORTED + AUTOSAVED
@@ -330,7 +372,12 @@ def deconvolve_tif(input_dir,
                       mip,
                       image_dimensions,
                       chunk_size,
-                      mode):
+                      mode,
+                      psf_energy=None,
+                      niter=None,
+                      accelerate=False,
+                      tol=None,
+                      block_workers=1):
  
     """
     Process the images from the given directories.
@@ -339,14 +386,24 @@ def deconvolve_tif(input_dir,
     - input_dir: List of directories containing the images to process.
     - output_dir_prefix: Prefix for the output directories.
     - cycle: Number of ISS cycle to be processed.
-    - deconvolution_method: 'redlionfish' (gpu) or 'deconwolf' (cpu)
+    - deconvolution_method: 'redlionfish' (gpu), 'native' (cpu, in-process scipy.fft) or 'deconwolf' (cpu)
     - image_dimensions: Dimensions of the images (default: [2048, 2048]).
     - PSF_metadata: Metadata for Point Spread Function (PSF) generation.
     - chunk_size [x,y]: Size of chunks for processing. If None, the entire image is processed.
-                  Small GPUs will require chunking. Enable if you run out of gRAM
+                  Small GPUs will require chunking. Enable if you run out of gRAM (or RAM). RedLionfish and native
+                  deconvolve the chunks with deconvolve_blocks, deconwolf with its own --tilesize.
+    - block_workers: Number of chunks deconvolved at once by RedLionfish or native. Default 1.
     - mip: Boolean to decide whether to apply maximum intensity projection. Default is True. 
            If mip=false the stack is deconvolved but saved as an image stack without projecting it
     - mode='autosaved', ='exported' if exported via the export function in LasX
+    - psf_energy: Optional fraction of the PSF energy, e.g. 0.999. The RedLionfish and native PSFs are then
+                  generated only over the window that carries it instead of over the whole tile, and padded
+                  to the tile by the deconvolution.
+    - niter: Number of iterations (maximum number with tol). Default 50 for RedLionfish and native, 20 for deconwolf.
+    - accelerate: Native only. Biggs-Andrews accelerated Richardson-Lucy, which needs far fewer iterations,
+                  e.g. niter=20 instead of 50. Deconwolf always accelerates (its default 'shb' method).
+    - tol: Native and deconwolf only. Stop a tile early once an iteration changes it by less than tol relative
+           to its sum, e.g. 0.005 (passed to deconwolf as --relerror).
 
     Returns:
     None. Processed images are saved in the output directories.
@@ -361,6 +418,9 @@ def deconvolve_tif(input_dir,
     if PSF_metadata is None:
         raise ValueError("PSF_metadata is required to generate PSF.")
 
+    if deconvolution_method == 'redlionfish' and (accelerate or tol is not None):
+        raise ValueError("accelerate and tol are not available with RedLionfish, use deconvolution_method='native'.")
+
     if mode is None:
         raise ValueError("Leica saving mode must be specified as either 'autosaved' or 'exported'.")
 
@@ -376,6 +436,7 @@ def deconvolve_tif(input_dir,
     print("\033[1;96m>> Using Deconvolution method: {} <<\033[0m".format(
     "Deconwolf" if deconvolution_method == "deconwolf"
     else "RedLionFish" if deconvolution_method == "redlionfish"
+    else "Native (scipy.fft)" if deconvolution_method == "native"
     else f"Unknown ({deconvolution_method})"))
 
     base = cycle
@@ -388,13 +449,11 @@ def deconvolve_tif(input_dir,
     # identify regions, and prepare region numbers based on naming convention.
     
     tif_files = [f for f in os.listdir(input_dir) if f.endswith('.tif') and 'dw' not in f and '.txt' not in f]
+    catalogue = build_file_catalogue(input_dir, mode, files=tif_files)
+    planes = index_catalogue(catalogue, ['region', 'tile', 'channel'])
 
-    if mode == 'autosaved':
-        regions = sorted(set(f.split('--')[0] for f in tif_files))
-        region_numbers = sorted(set(re.search(r'Region\s*(\d+)', r).group(1) for r in regions))
-    elif mode == 'exported':
-        regions = sorted(set(re.search(r'(Region\s*\d+)', f).group(1) for f in tif_files))
-        region_numbers = sorted(set(re.search(r'Region\s*(\d+)', r).group(1) for r in regions))
+    regions = sorted(catalogue['region'].unique())
+    region_numbers = sorted(set(re.search(r'Region\s*(\d+)', r).group(1) for r in regions))
 
     print("Regions to be processed:", regions)
 
@@ -404,13 +463,10 @@ def deconvolve_tif(input_dir,
 
     for region_index, region in enumerate(regions):
         print(f"\033[1;90mProcessing Region {region_index + 1}/{len(regions)}\033[0m")
-        filtered_tifs = [f for f in tif_files if region in f]
-        
-        if mode == 'autosaved':
-            tiles = pd.Series(filtered_tifs).str.split('--').str[1].str.extract(r'(\d+)')[0].dropna().unique()
-        elif mode == 'exported':
-            tiles = pd.Series(filtered_tifs).str.extract(r'_s(\d+)_')[0].dropna().unique()
-        tiles = sorted(tiles, key=int)
+        region_catalogue = catalogue[catalogue['region'] == region]
+        tiles = sorted(region_catalogue['tile'].unique(), key=int)
+        # File name channel ('C00', 'ch00') of every channel number, the PSF_metadata channels are numbers
+        channel_names = {int(name.lstrip('Cch')): name for name in region_catalogue['channel'].unique()}
 
         print('Sorted tiles:', tiles)
 
@@ -443,17 +499,14 @@ def deconvolve_tif(input_dir,
                 os.path.join(base_directory, 'MetaData')
             )
 
-        # =============================== RedLionFish Deconvolution ===============================
-        if deconvolution_method == 'redlionfish':
+        # ========================= RedLionFish / Native Deconvolution =========================
+        if deconvolution_method in ('redlionfish', 'native'):
         
             # ----- Step 6: Generate PSFs for all channels -----
             # Calculate PSF size from a sample tile and create PSFs for each channel
         
             print("Calculating the PSF...")
-            if mode == 'autosaved':
-                sample_tile = [f for f in filtered_tifs if f"--Stage00--" in f]
-            elif mode == 'exported':
-                sample_tile = [f for f in filtered_tifs if f"_s0_" in f]
+            sample_tile = region_catalogue[region_catalogue['tile'] == tiles[0]]
         
             size_z = int(len(sample_tile) / len(PSF_metadata['channels']))
         
@@ -469,17 +522,20 @@ def deconvolve_tif(input_dir,
                     size_x=image_dimensions[0],
                     size_y=image_dimensions[1],
                     size_z=size_z
-                ).generate()
+                ).generate_cached(energy=psf_energy)
+
+            # The native engine keeps the OTF of each channel for all tiles
+            if deconvolution_method == 'native':
+                engines = {channel: RichardsonLucy(psf) for channel, psf in psf_dict.items()}
+
+            # Blocks of chunk_size are read with a halo that carries the PSF energy around them
+            if chunk_size:
+                halos = {channel: psf_halo(psf, psf_energy or 0.999) for channel, psf in psf_dict.items()}
         
             # ----- Step 7: Deconvolve each tile and channel -----
-            # Stack z-planes, deconvolve with RedLionFish
+            # Stack z-planes, deconvolve with RedLionFish or the native engine
                         
             for tile in tqdm(sorted(tiles, key=int)):
-                if mode == 'autosaved':
-                    tile_files = [f for f in filtered_tifs if f"--Stage{tile}--" in f]
-                elif mode == 'exported':
-                    tile_files = [f for f in filtered_tifs if f"_s{tile}_" in f]
-        
                 for channel in sorted(PSF_metadata['channels']):
                     print(f"\033[90m[Cycle {base}] Tile {tile}, Channel {channel}...\033[0m")
                     tile_channel_start = time.time()
@@ -491,19 +547,25 @@ def deconvolve_tif(input_dir,
                         continue
         
                     # ----- Step 7a: Stack z-planes into 3D image -----
-                    if mode == 'autosaved':
-                        channel_files = [f for f in tile_files if f"--C{str(channel).zfill(2)}" in f]
-                    elif mode == 'exported':
-                        channel_files = [f for f in tile_files if f"_ch{channel}" in f]
+                    channel_files = planes.get((region, tile, channel_names.get(int(channel))), [])
         
                     stacked_images = np.stack([
                         tifffile.imread(os.path.join(input_dir, f)) for f in channel_files
                     ])
         
-                    # ----- Step 7b: Run RedLionFish deconvolution -----
+                    # ----- Step 7b: Run RedLionFish (or native) deconvolution -----
                     
-                    deconvolved_img = rl.doRLDeconvolutionFromNpArrays(
-                        stacked_images, psf_dict[channel], niter=50)
+                    if deconvolution_method == 'native':
+                        deconvolve = partial(engines[channel].run, niter=niter or 50, accelerate=accelerate, tol=tol)
+                    else:
+                        deconvolve = partial(rl.doRLDeconvolutionFromNpArrays, psf_np=psf_dict[channel],
+                                             niter=niter or 50)
+
+                    if chunk_size:
+                        deconvolved_img = deconvolve_blocks(stacked_images, deconvolve, chunk_size, halos[channel],
+                                                            n_workers=block_workers)
+                    else:
+                        deconvolved_img = deconvolve(stacked_images)
         
                     # ----- Step 8: Post-process output (mip or full stack) -----
                     # Apply MIP if enabled, or keep full deconvolved stack.
@@ -546,11 +608,6 @@ def deconvolve_tif(input_dir,
             # Stack z-planes for each tile and channel, then deconvolve using Deconwolf.
             
             for tile in tqdm(sorted(tiles, key=int)):
-                if mode == 'autosaved':
-                    tile_files = [f for f in filtered_tifs if f"--Stage{tile}--" in f]
-                elif mode == 'exported':
-                    tile_files = [f for f in filtered_tifs if f"_s{tile}_" in f]
-
                 dw_tmp_dir = os.path.join(base_directory, 'deconwolf tmp')
                 os.makedirs(dw_tmp_dir, exist_ok=True)
             
@@ -570,10 +627,7 @@ def deconvolve_tif(input_dir,
                     # ----- Step 7a: Stack z-planes for each tile/channel -----
                     # Load all matching channel images for a tile, stack them into a 3D array and write to disk.
             
-                    if mode == 'autosaved':
-                        channel_files = [f for f in tile_files if f"--C{str(channel).zfill(2)}" in f]
-                    elif mode == 'exported':
-                        channel_files = [f for f in tile_files if f"_ch{channel}" in f]
+                    channel_files = planes.get((region, tile, channel_names.get(int(channel))), [])
                     
                     stacked_images = np.stack([
                         tifffile.imread(os.path.join(input_dir, f)) for f in channel_files
@@ -588,8 +642,9 @@ def deconvolve_tif(input_dir,
                         input_image=dw_input,
                         psf_image=psf_dict[channel],
                         output_image=dw_output,
-                        iterations=20,
-                        tilesize=chunk_size
+                        iterations=niter or 20,
+                        tilesize=chunk_size,
+                        relerror=tol
                     )
                     
                     # ----- Step 8: Post-process output (mip or full stack) -----
@@ -643,7 +698,12 @@ def deconvolve_lif(input_dir,
                       PSF_metadata, 
                       mip,
                       image_dimensions,
-                      chunk_size):
+                      chunk_size,
+                      psf_energy=None,
+                      niter=None,
+                      accelerate=False,
+                      tol=None,
+                      block_workers=1):
 
     
     """
@@ -653,14 +713,24 @@ def deconvolve_lif(input_dir,
     - input_dir: List of directories containing the images to process.
     - output_dir_prefix: Prefix for the output directories.
     - cycle: Number of ISS cycle to be processed.
-    - deconvolution_method: 'redlionfish' (gpu) or 'deconwolf' (cpu)
+    - deconvolution_method: 'redlionfish' (gpu), 'native' (cpu, in-process scipy.fft) or 'deconwolf' (cpu)
     - image_dimensions: Dimensions of the images (default: [2048, 2048]).
     - PSF_metadata: Metadata for Point Spread Function (PSF) generation.
     - chunk_size [x,y]: Size of chunks for processing. If None, the entire image is processed.
-                  Small GPUs will require chunking. Enable if you run out of gRAM
+                  Small GPUs will require chunking. Enable if you run out of gRAM (or RAM). RedLionfish and native
+                  deconvolve the chunks with deconvolve_blocks, deconwolf with its own --tilesize.
+    - block_workers: Number of chunks deconvolved at once by RedLionfish or native. Default 1.
     - mip: Boolean to decide whether to apply maximum intensity projection. Default is True. 
            If mip=false the stack is deconvolved but saved as an image stack without projecting it
     - mode='autosaved', ='exported' if exported via the export function in LasX
+    - psf_energy: Optional fraction of the PSF energy, e.g. 0.999. The RedLionfish and native PSFs are then
+                  generated only over the window that carries it instead of over the whole tile, and padded
+                  to the tile by the deconvolution.
+    - niter: Number of iterations (maximum number with tol). Default 50 for RedLionfish and native, 20 for deconwolf.
+    - accelerate: Native only. Biggs-Andrews accelerated Richardson-Lucy, which needs far fewer iterations,
+                  e.g. niter=20 instead of 50. Deconwolf always accelerates (its default 'shb' method).
+    - tol: Native and deconwolf only. Stop a tile early once an iteration changes it by less than tol relative
+           to its sum, e.g. 0.005 (passed to deconwolf as --relerror).
 
     Returns:
     None. Processed images are saved in the output directories.
@@ -685,10 +755,14 @@ def deconvolve_lif(input_dir,
     print("\033[1;96m>> Using Deconvolution method: {} <<\033[0m".format(
         "Deconwolf" if deconvolution_method == "deconwolf" 
         else "RedLionFish" if deconvolution_method == "redlionfish" 
+        else "Native (scipy.fft)" if deconvolution_method == "native" 
         else "Unknown"))
     
     if PSF_metadata is None:
         raise ValueError("PSF_metadata is required to generate PSF.")
+
+    if deconvolution_method == 'redlionfish' and (accelerate or tol is not None):
+        raise ValueError("accelerate and tol are not available with RedLionfish, use deconvolution_method='native'.")
   
     input_dir = input_dir.replace("%20", " ")
 
@@ -799,9 +873,9 @@ def deconvolve_lif(input_dir,
             xml_declaration=True)
 
         # ----- Step 7: Perform deconvolution -----
-        # RedLionFish and Deconwolf implementations differ here.
+        # RedLionFish (or the native engine) and Deconwolf implementations differ here.
         
-        if deconvolution_method == 'redlionfish':
+        if deconvolution_method in ('redlionfish', 'native'):
 
             # ----- Step 7a: Generate PSFs for all channels -----
             print('Calculating the PSF')
@@ -818,7 +892,15 @@ def deconvolve_lif(input_dir,
                     size_x=image_dimensions[0],
                     size_y=image_dimensions[1],
                     size_z=size_z
-                ).generate()
+                ).generate_cached(energy=psf_energy)
+
+            # The native engine keeps the OTF of each channel for all tiles
+            if deconvolution_method == 'native':
+                engines = {idx: RichardsonLucy(psf) for idx, psf in psf_dict.items()}
+
+            # Blocks of chunk_size are read with a halo that carries the PSF energy around them
+            if chunk_size:
+                halos = {idx: psf_halo(psf, psf_energy or 0.999) for idx, psf in psf_dict.items()}
                 
             # ----- Step 7b: Deconvolve each tile and channel -----
             print("Single tile imaging." if n_tiles == 1 else f"Number of tiles: {n_tiles}")
@@ -841,9 +923,18 @@ def deconvolve_lif(input_dir,
                         z_planes.append(z_data)
                     stacked_images = np.stack(z_planes, axis=0)
                 
-                    # Run RedLionFish deconvolution -----
-                    deconvolved_img = rl.doRLDeconvolutionFromNpArrays(
-                        stacked_images, psf_dict[channel], niter=50)
+                    # Run RedLionFish (or native) deconvolution -----
+                    if deconvolution_method == 'native':
+                        deconvolve = partial(engines[channel].run, niter=niter or 50, accelerate=accelerate, tol=tol)
+                    else:
+                        deconvolve = partial(rl.doRLDeconvolutionFromNpArrays, psf_np=psf_dict[channel],
+                                             niter=niter or 50)
+
+                    if chunk_size:
+                        deconvolved_img = deconvolve_blocks(stacked_images, deconvolve, chunk_size, halos[channel],
+                                                            n_workers=block_workers)
+                    else:
+                        deconvolved_img = deconvolve(stacked_images)
         
                     # Post-process output (MIP or full stack) -----
                     if mip:
@@ -915,8 +1006,9 @@ def deconvolve_lif(input_dir,
                         input_image=dw_input,
                         psf_image=psf_dict[str(channel)],
                         output_image=dw_output,
-                        iterations=20,
-                        tilesize=chunk_size
+                        iterations=niter or 20,
+                        tilesize=chunk_size,
+                        relerror=tol
                     )
     
                     # MIP or save full stack -----
@@ -956,7 +1048,7 @@ def deconvolve_lif(input_dir,
 This functions has been developed around a dataset that is not representative of the typical nd2 format
 Tiles should be in the 'm' loop while in this case they are in the 'p' loop which I think it is for positions of
 single FOVs.
-def deconvolve_nd2 (input_file, outpath, mip=True, PSF_metadata=None, cycle=0):
+def deconvolve_nd2 (input_file, outpath, mip=True, PSF_metadata=None, cycle=0, psf_energy=None):
     """
     Process nd2 files, deconvolve and apply maximum intensity projection (if specified), 
     and create an associated XML with metadata.
@@ -966,6 +1058,7 @@ def deconvolve_nd2 (input_file, outpath, mip=True, PSF_metadata=None, cycle=0):
     - outpath: Directory where the processed images and XML will be saved.
     - mip: Boolean to decide whether to apply maximum intensity projection. Default is True.
     - cycle: Int to specify the cycle number. Default is 0.
+    - psf_energy: Optional fraction of the PSF energy, e.g. 0.999, see deconvolve_tif.
     
     Returns:
     - A string indicating that processing is complete.
@@ -1059,7 +1152,7 @@ def deconvolve_nd2 (input_file, outpath, mip=True, PSF_metadata=None, cycle=0):
                     size_x=tile_size_x,
                     size_y=tile_size_y,
                     size_z=z_size  # Use the Z dimension from the CZI file
-                ).generate()
+                ).generate_cached(energy=psf_energy)
             for ch in range (0, chsize):
                 print ('Deconvolving channel '+str(ch))
                 # Get metadata and image data for the current tile and channel.
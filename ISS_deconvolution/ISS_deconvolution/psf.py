@@ -4,7 +4,9 @@ This is the exact same implementation (used with permission from
 http://kmdouglass.github.io/posts/implementing-a-fast-gibson-lanni-psf-solver-in-python.html)
 """
 import argparse
+import hashlib
 import json
+import os
 from collections import OrderedDict
 
 
@@ -99,6 +101,12 @@ GL_PSF_ARGS = [
 ]
 
 
+# Generated PSFs are cached in memory (up to PSF_MEMORY_CACHE_SIZE of them) and on disk, see GibsonLanni.generate_cached
+PSF_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ISS_deconvolution', 'psf')
+PSF_MEMORY_CACHE_SIZE = 8
+PSF_MEMORY_CACHE = OrderedDict()
+
+
 class PSF(object):
     pass
 
@@ -171,10 +179,52 @@ class GibsonLanni(PSF):
 
         return parser
 
-    def generate(self):
+    def generate_cached(self, energy=None, dtype='float32', cache_dir=PSF_CACHE_DIR):
+        """ Generate the PSF once per configuration and reuse it
+
+        The PSF is keyed by the JSON of the configuration, energy and dtype. It is kept in memory for
+        later calls in the same process and saved as <cache_dir>/<key>.npy for later runs. The returned
+        array is shared between calls and therefore read-only.
+
+        Args:
+            energy: See generate.
+            dtype: See generate. Default is float32, the precision the deconvolution runs in.
+            cache_dir: Folder of the disk cache. None only caches in memory.
+        """
+        import numpy as np
+
+        key = hashlib.sha256(json.dumps({'config': self.config, 'energy': energy, 'dtype': np.dtype(dtype).str},
+                                        sort_keys=True).encode()).hexdigest()
+        if key in PSF_MEMORY_CACHE:
+            PSF_MEMORY_CACHE.move_to_end(key)
+            return PSF_MEMORY_CACHE[key]
+
+        path = os.path.join(cache_dir, key + '.npy') if cache_dir else None
+        if path and os.path.exists(path):
+            psf = np.load(path)
+        else:
+            psf = self.generate(energy=energy, dtype=dtype)
+            if path:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path + '.part', 'wb') as fd:
+                    np.save(fd, psf)
+                os.replace(path + '.part', path)
+
+        psf.flags.writeable = False
+        PSF_MEMORY_CACHE[key] = psf
+        while len(PSF_MEMORY_CACHE) > PSF_MEMORY_CACHE_SIZE:
+            PSF_MEMORY_CACHE.popitem(last=False)
+        return psf
+
+    def radial_profile(self):
+        """ Compute the PSF along the radial coordinate, the first step of generate
+
+        Returns:
+            r: Radial coordinates (microns) up to the corner of a size_x by size_y array.
+            PSF_rz: PSF as a [z, r] array with a maximum of 1.
+        """
         import numpy as np
         import scipy.special
-        from scipy.interpolate import interp1d
 
         # ################# #
         # Define Parameters #
@@ -270,29 +320,73 @@ class GibsonLanni(PSF):
 
         # Normalize to the maximum value
         PSF_rz /= np.max(PSF_rz)
+        return r, PSF_rz
 
-        # ############################################################# #
-        # Resample the PSF onto a rotationally-symmetric Cartesian grid #
-        # ############################################################# #
+    # **All methods below are changes to original implementation** #
+
+    def support_radius(self, energy=0.999, profile=None):
+        """ Radius (pixels) of the disc that carries the given fraction of the PSF energy over all z-slices
+
+        Args:
+            energy: Fraction of the PSF integral, e.g. 0.999.
+            profile: Optional (r, PSF_rz) from radial_profile, to avoid computing it again.
+        """
+        import numpy as np
+
+        r, PSF_rz = profile if profile is not None else self.radial_profile()
+        # The energy of a ring is proportional to its radius
+        ring_energy = np.cumsum(PSF_rz.sum(axis=0) * r)
+        index = min(np.searchsorted(ring_energy, energy * ring_energy[-1]), len(r) - 1)
+        return r[index] / self.config['res_lateral']
+
+    def generate(self, energy=None, dtype='float64'):
+        """ Generate the PSF as a [z, y, x] array with a maximum of 1
+
+        Args:
+            energy: Optional fraction of the PSF energy, e.g. 0.999. Only the smallest centered window
+                holding this fraction (see support_radius) is generated, instead of size_x by size_y.
+                The parity of the size is kept, so the PSF stays centered when a deconvolver pads it
+                back to the image size.
+            dtype: Data type of the returned array. Default is float64.
+        """
+        import numpy as np
+
+        size_x = self.config['size_x']
+        size_y = self.config['size_y']
+        res_lateral = self.config['res_lateral']
 
-        # Create the fleshed-out xy grid of radial distances from the center
-        xy      = np.mgrid[0:size_y, 0:size_x]
-        r_pixel = np.sqrt((xy[1] - x0) * (xy[1] - x0) + (xy[0] - y0) * (xy[0] - y0)) * res_lateral
+        r, PSF_rz = self.radial_profile()
 
-        PSF = np.zeros((size_y, size_x, size_z))
+        if energy is not None:
+            half = int(np.ceil(self.support_radius(energy, (r, PSF_rz)))) + 1
+            size_x = min(size_x, 2 * half + size_x % 2)
+            size_y = min(size_y, 2 * half + size_y % 2)
+        x0 = (size_x - 1) / 2
+        y0 = (size_y - 1) / 2
 
-        for z_index in range(PSF.shape[2]):
-            # Interpolate the radial PSF function
-            PSF_interp = interp1d(r, PSF_rz[z_index, :])
+        # ############################################################# #
+        # Resample the PSF onto a rotationally-symmetric Cartesian grid #
+        # ############################################################# #
 
-            # Evaluate the PSF at each value of r_pixel
-            PSF[:,:, z_index] = PSF_interp(r_pixel.ravel()).reshape(size_y, size_x)
+        # The PSF is symmetric about the center, so only the lower right quadrant is interpolated,
+        # for all z-slices at once, and mirrored into the other three
+        qy = np.arange(size_y // 2, size_y)
+        qx = np.arange(size_x // 2, size_x)
+        r_pixel = np.sqrt(((qy.reshape(-1, 1) - y0) ** 2 + (qx - x0) ** 2).ravel()) * res_lateral
 
-        # **All lines below are changes to original implementation** #
+        # Linear interpolation of the radial PSF function, as np.interp, with the weights shared by all z-slices
+        index = np.clip(np.searchsorted(r, r_pixel, side='right') - 1, 0, len(r) - 2)
+        weight = ((r_pixel - r[index]) / (r[index + 1] - r[index])).astype(dtype)
+        PSF_rz = PSF_rz.astype(dtype)
+        quadrant = PSF_rz[:, index] * (1 - weight) + PSF_rz[:, index + 1] * weight
+        quadrant = quadrant.reshape(-1, len(qy), len(qx))
 
-        # Transform to [z, y, x] instead of [y, x, z]
-        PSF = np.moveaxis(PSF, 2, 0)
+        # Mirror the quadrant, giving the PSF as [z, y, x]
+        my = np.maximum(np.arange(size_y), size_y - 1 - np.arange(size_y)) - size_y // 2
+        mx = np.maximum(np.arange(size_x), size_x - 1 - np.arange(size_x)) - size_x // 2
+        PSF = quadrant[:, my.reshape(-1, 1), mx]
 
         # Re-normalize to a max of 1
-        return PSF / np.max(PSF)
+        PSF /= np.max(PSF)
+        return PSF
 
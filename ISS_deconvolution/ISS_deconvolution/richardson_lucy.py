@@ -0,0 +1,169 @@
+"""Richardson-Lucy deconvolution on the CPU with NumPy and scipy.fft
+
+The optical transfer function (OTF) of the PSF is computed once per FFT shape and reused for every
+tile deconvolved with it, so one RichardsonLucy per channel serves a whole cycle. The FFTs run
+multi-threaded through the scipy.fft workers, and scipy.fft keeps the plans for a shape cached
+between iterations and tiles.
+"""
+import threading
+
+import numpy as np
+import scipy.fft
+
+
+def pad_psf(psf, shape):
+    """
+    Zero-pad (or crop) a [z, y, x] PSF to shape, keeping it centered as RedLionfish does.
+    Compact PSFs from GibsonLanni.generate(energy=...) are padded like this where a kernel
+    the size of the image or chunk is needed.
+    """
+    padded = np.zeros(shape, dtype=psf.dtype)
+    src, dst = [], []
+    for n, m in zip(psf.shape, shape):
+        offset = int((m - n) / 2)
+        src.append(slice(max(-offset, 0), max(-offset, 0) + min(n, m)))
+        dst.append(slice(max(offset, 0), max(offset, 0) + min(n, m)))
+    padded[tuple(dst)] = psf[tuple(src)]
+    return padded
+
+
+class RichardsonLucy(object):
+
+    def __init__(self, psf, n_threads=None):
+        """ Richardson-Lucy deconvolution of [z, y, x] images with one PSF
+
+        Args:
+            psf: [z, y, x] PSF, e.g. from GibsonLanni.generate. It may be smaller than the
+                images (see GibsonLanni.generate(energy=...)), it is centered in the FFT shape.
+            n_threads: Number of scipy.fft workers, all CPUs if None
+        """
+        psf = np.asarray(psf, dtype=np.float32)
+        self.psf = psf / psf.sum()
+        self.workers = n_threads or -1
+        self.otfs = {}
+        # Work buffers are per thread, so that blocks of a tile can be deconvolved concurrently
+        self.local = threading.local()
+
+    def padding(self, shape):
+        """ Reflect padding before and after every axis of an image of shape: half the PSF size, so that
+        the circular convolution does not wrap one edge of the image into the other, plus what it takes
+        to reach the next fast FFT length """
+        padding = []
+        for n, k in zip(shape, self.psf.shape):
+            m = scipy.fft.next_fast_len(n + 2 * (k // 2), real=True)
+            padding.append((k // 2, m - n - k // 2))
+        return padding
+
+    def otf(self, fft_shape):
+        """ rfftn of the PSF centered at the origin of fft_shape and its conjugate (the OTF of
+        the mirrored PSF), computed once per shape """
+        if fft_shape not in self.otfs:
+            center = [int((m - n) / 2) + n // 2 for n, m in zip(self.psf.shape, fft_shape)]
+            kernel = np.roll(pad_psf(self.psf, fft_shape), [-c for c in center], axis=(0, 1, 2))
+            otf = scipy.fft.rfftn(kernel, workers=self.workers)
+            self.otfs[fft_shape] = otf, np.conj(otf)
+        return self.otfs[fft_shape]
+
+    def work_buffers(self, fft_shape, count):
+        """ count float32 arrays of fft_shape, allocated once per thread and reused for every tile.
+        Buffers are kept for the last few shapes only, e.g. the inner and edge blocks of a tile. """
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        buffers = self.local.buffers.pop(fft_shape, [])
+        buffers += [np.empty(fft_shape, dtype=np.float32) for _ in range(count - len(buffers))]
+        self.local.buffers[fft_shape] = buffers
+        while len(self.local.buffers) > 4:
+            del self.local.buffers[next(iter(self.local.buffers))]
+        return buffers[:count]
+
+    def convolve(self, image, otf, out):
+        """ Circular convolution of image with the transfer function otf into out """
+        spectrum = scipy.fft.rfftn(image, workers=self.workers)
+        spectrum *= otf
+        out[...] = scipy.fft.irfftn(spectrum, s=out.shape, workers=self.workers, overwrite_x=True)
+        return out
+
+    def run(self, image, niter=50, accelerate=False, tol=None):
+        """ Deconvolve a [z, y, x] image
+
+        The image is reflect-padded by half the PSF size on every side (and up to a fast FFT length),
+        deconvolved, and cropped back, so that blur does not wrap around between opposite edges, e.g.
+        the top and bottom z-planes. A compact PSF (GibsonLanni.generate(energy=...)) keeps the padding
+        small. The estimate starts from the image, as in RedLionfish.
+
+        With accelerate, every iteration starts from the estimate extrapolated along its last
+        change (Biggs & Andrews, Appl. Opt. 36, 1997), with the step scaled by the correlation
+        of the last two RL updates. This reaches the quality of plain RL in a fraction of the
+        iterations.
+
+        Args:
+            image: [z, y, x] image
+            niter: (Maximum) number of iterations
+            accelerate: Use Biggs-Andrews vector extrapolation
+            tol: Stop early once the RL update of an iteration changes the estimate by less than tol,
+                relative to its sum (L1), e.g. 0.005. With accelerate, the extrapolation step is not
+                counted. None always runs niter iterations.
+
+        Returns:
+            Deconvolved float32 image of the same shape. The number of iterations run is kept
+            in self.iterations.
+        """
+        shape = image.shape
+        padding = self.padding(shape)
+        data = np.pad(np.asarray(image, dtype=np.float32), padding, mode='reflect')
+        fft_shape = data.shape
+        otf, otf_mirror = self.otf(fft_shape)
+
+        buffers = self.work_buffers(fft_shape, 5 if accelerate else 3 if tol else 2)
+        estimate, ratio = buffers[:2]
+        estimate[...] = data
+        eps = np.finfo(np.float32).tiny
+
+        self.iterations = 0
+        for i in range(niter):
+            if accelerate:
+                previous, step, last_step = buffers[2:]
+                if i >= 2:
+                    # y = x + alpha * (x - x_previous), into the buffer of x_previous
+                    alpha = np.dot(step.ravel(), last_step.ravel()) / max(
+                        np.dot(last_step.ravel(), last_step.ravel()), eps)
+                    np.subtract(estimate, previous, out=previous)
+                    previous *= np.clip(alpha, 0, 1)
+                    previous += estimate
+                    np.maximum(previous, 0, out=previous)
+                    estimate, previous = previous, estimate
+                else:
+                    previous[...] = estimate
+            elif tol:
+                previous = buffers[2]
+                previous[...] = estimate
+
+            self.convolve(estimate, otf, out=ratio)
+            np.maximum(ratio, eps, out=ratio)
+            np.divide(data, ratio, out=ratio)
+            self.convolve(ratio, otf_mirror, out=ratio)
+
+            if accelerate:
+                # The RL update of the extrapolated estimate, step = y * (ratio - 1)
+                step, last_step = last_step, step
+                np.subtract(ratio, 1, out=step)
+                step *= estimate
+                estimate += step
+                buffers[2:] = previous, step, last_step
+            else:
+                estimate *= ratio
+            np.maximum(estimate, 0, out=estimate)
+            self.iterations = i + 1
+
+            if tol:
+                # The change made by the RL update alone, not by the extrapolation, so that
+                # plain and accelerated runs stop on the same criterion
+                if accelerate:
+                    np.abs(step, out=ratio)
+                else:
+                    np.subtract(estimate, previous, out=ratio)
+                    np.abs(ratio, out=ratio)
+                if ratio.sum(dtype=np.float64) < tol * estimate.sum(dtype=np.float64):
+                    break
+
+        return estimate[tuple(slice(before, before + n) for (before, _), n in zip(padding, shape))].copy()
@@ -0,0 +1,25 @@
+import numpy as np
+from scipy.signal import fftconvolve
+
+from ISS_deconvolution.richardson_lucy import RichardsonLucy
+
+
+def blurred_beads(seed=0):
+    """A noisy [z, y, x] stack of beads blurred with a Gaussian PSF, and the PSF"""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[-3:4, -5:6, -5:6]
+    psf = np.exp(-(x ** 2 + y ** 2) / 4 - z ** 2 / 2)
+    truth = np.zeros((10, 96, 96))
+    truth[rng.integers(0, 10, 100), rng.integers(0, 96, 100), rng.integers(0, 96, 100)] = 1000
+    blurred = np.clip(fftconvolve(truth, psf / psf.sum(), mode='same'), 0, None)
+    return rng.poisson(blurred + 5).astype(np.uint16), psf
+
+
+def test_accelerated_stops_no_later_than_plain():
+    image, psf = blurred_beads()
+    engine = RichardsonLucy(psf)
+    for tol in (0.01, 0.005):
+        engine.run(image, niter=200, tol=tol)
+        plain = engine.iterations
+        engine.run(image, niter=200, accelerate=True, tol=tol)
+        assert 1 < engine.iterations <= plain < 200
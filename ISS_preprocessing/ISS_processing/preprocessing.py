@@ -19,6 +19,28 @@ import requests
 from readlif.reader import LifFile
 import xml.etree.ElementTree as ET
 from natsort import natsorted
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from collections import deque
+import hashlib
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional, only used to cap the BLAS/OpenMP threads of Ashlar
+    threadpool_limits = None
+from ISS_common.files import FILE_NAMING_PATTERNS, build_file_catalogue, index_catalogue
+from ISS_common.czi import czi_tile_positions, write_czi_export_xml
 
 
 def customcopy(src, dst):
@@ -27,58 +49,224 @@ def customcopy(src, dst):
     shutil.copyfile(src, dst)
 
 
-def zen_OME_tiff(exported_directory, output_directory, channel_split=2, cycle_split=1, num_channels=5):
+def read_plane(path):
+    """
+    Read a single image plane, memory-mapping it when the TIFF allows it.
+
+    Uncompressed, contiguous TIFFs are mapped instead of being copied into memory.
+    Anything tifffile cannot map (compressed, tiled, non-contiguous) is read normally.
+    """
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return tifffile.imread(path)
+
+
+def max_project_planes(planes, out=None):
+    """
+    Streaming maximum intensity projection.
+
+    The accumulator keeps the dtype of the first plane and every following plane is
+    folded into it in place, so no z-stack and no float64 intermediate is ever built.
+
+    Parameters:
+    - planes: Iterable of 2D arrays (a list, a generator of memmaps, ...).
+    - out: Optional preallocated accumulator to project into. Its current content takes part in the max.
+
+    Returns:
+    - The projected 2D array, or None if planes was empty and no out was given.
+    """
+    acc = out
+    for plane in planes:
+        if acc is None:
+            acc = np.array(plane, copy=True)
+        else:
+            np.maximum(acc, plane, out=acc)
+    return acc
+
+
+def zen_OME_tiff(exported_directory, output_directory, channel_split=2, cycle_split=1, num_channels=5, n_workers=1,
+                 tile=None, compression=None, subresolutions=0):
     '''
     This function makes OME-TIFF files from files exported from as tiff from ZEN, through the process_czi or to the deconvolve_czi functions.
-    Note: Assumes Nilsson SOP naming. Works on 1-tile sections.
+    Note: Assumes Nilsson SOP naming (Base_<cycle>_c<channel>m<tile>_ORG.tif). Works on 1-tile sections.
+    channel_split and cycle_split are kept for backwards compatibility, file names are parsed by build_file_catalogue.
+    With n_workers > 1 the cycles are written in parallel worker processes, one progress bar per cycle.
+    tile, compression and subresolutions set the storage of the OME-TIFFs, see write_OME_tiff.
     '''
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     all_files = os.listdir(exported_directory)
-    tiff_files = [f for f in all_files if f.endswith('.tif')]
-    split_tiles_df = pd.DataFrame(tiff_files)[0].str.split('m', expand=True)
-    split_ch_df = split_tiles_df[0].str.split('_', expand=True)
-    tiles = list(np.unique(split_tiles_df[1]))
-    channels = list(np.unique(split_ch_df[channel_split]))
-    rounds = list(np.unique(split_ch_df[cycle_split]))
-
-    for rnd in rounds:
-        files_rnd = [f for f in tiff_files if f'Base_{rnd}_' in f]
-        meta_files = [f for f in all_files if 'info.xml' in f and f'_{rnd}_' in f]
-        for mfile in meta_files:
-            doc = minidom.parse(join(exported_directory, mfile))
-            tiles_xml, xs, ys = [], [], []
-            for b in doc.getElementsByTagName('Bounds'):
-                tiles_xml.append(int(b.attributes['StartM'].value))
-                xs.append(float(b.attributes['StartX'].value))
-                ys.append(float(b.attributes['StartY'].value))
-            uniq = list(np.unique(tiles_xml))
-            pos_df = pd.DataFrame({'x': xs[:len(uniq)], 'y': ys[:len(uniq)]})
-            positions = np.array(pos_df).astype(int)
-
-        with tifffile.TiffWriter(join(output_directory, f'cycle_{rnd}.ome.tif'), bigtiff=True) as tif:
-            for i, tile in enumerate(tiles):
-                pos = positions[i]
-                tile_files = [f for f in files_rnd if f'm{tile}' in f and not f.startswith('._')]
-                stack = np.empty((num_channels, 2048, 2048), dtype='uint16')
-                for idx, imgf in enumerate(sorted(tile_files)):
-                    img = tifffile.imread(join(exported_directory, imgf))
-                    stack[idx] = img.astype('uint16')
-                pix = 0.1625
-                meta = {
-                    'Pixels': {
-                        'PhysicalSizeX': pix, 'PhysicalSizeXUnit': 'µm',
-                        'PhysicalSizeY': pix, 'PhysicalSizeYUnit': 'µm'
-                    },
-                    'Plane': {
-                        'PositionX': [pos[0]*pix]*stack.shape[0],
-                        'PositionY': [pos[1]*pix]*stack.shape[0]
-                    }
-                }
-                tif.write(stack, metadata=meta)
+    catalogue = build_file_catalogue(exported_directory, 'zen', files=all_files)
+    rounds = sorted(catalogue['base'].unique(), key=int)
+
+    jobs = [(exported_directory, output_directory, rnd, num_channels, all_files, i + 1 if n_workers > 1 else None,
+             tile, compression, subresolutions)
+            for i, rnd in enumerate(rounds)]
+    run_mip_jobs(jobs, n_workers, worker=zen_cycle_OME_tiff)
+
+
+def zen_cycle_OME_tiff(exported_directory, output_directory, rnd, num_channels=5, all_files=None, position=None,
+                       tile=None, compression=None, subresolutions=0):
+    """
+    Write the OME-TIFF of a single ZEN cycle, cycle_<rnd>.ome.tif. Used by zen_OME_tiff.
+
+    Parameters:
+    - exported_directory: Directory with the exported TIFFs and the *info.xml files.
+    - output_directory: Directory to write the OME-TIFF to.
+    - rnd: Cycle number, as in the file names.
+    - num_channels: Number of channels per tile.
+    - all_files: Listing of exported_directory, if already available.
+    - position: Line of the progress bar, when several cycles are written at once.
+    - tile, compression, subresolutions: Storage of the OME-TIFF, see write_OME_tiff.
+    """
+    if all_files is None:
+        all_files = os.listdir(exported_directory)
+    catalogue = build_file_catalogue(exported_directory, 'zen', files=all_files)
+    catalogue = catalogue[catalogue['base'] == rnd]
+    catalogue = catalogue.sort_values(by='channel', key=lambda c: c.astype(int), kind='stable')
+    tile_files = index_catalogue(catalogue, ['tile'])
+    tiles = sorted(catalogue['tile'].unique(), key=int)
+
+    meta_files = [f for f in all_files if 'info.xml' in f and f'_{rnd}_' in f]
+    for mfile in meta_files:
+        doc = minidom.parse(join(exported_directory, mfile))
+        tiles_xml, xs, ys = [], [], []
+        for b in doc.getElementsByTagName('Bounds'):
+            tiles_xml.append(int(b.attributes['StartM'].value))
+            xs.append(float(b.attributes['StartX'].value))
+            ys.append(float(b.attributes['StartY'].value))
+        uniq = list(np.unique(tiles_xml))
+        pos_df = pd.DataFrame({'x': xs[:len(uniq)], 'y': ys[:len(uniq)]})
+        positions = np.array(pos_df).astype(int)
+
+    def tile_stacks():
+        # The stack is sized from the first file found, a tile without files is written empty.
+        first = next((f for tile in tiles for f in tile_files.get((tile,), [])), None)
+        if first is None:
+            raise FileNotFoundError(f"No exported TIFFs of cycle {rnd} found in {exported_directory}.")
+        stack = np.zeros((num_channels, *read_plane(join(exported_directory, first)).shape), dtype='uint16')
+        for tile in tiles:
+            files = tile_files.get((tile,), [])
+            for idx, imgf in enumerate(files):
+                stack[idx] = read_plane(join(exported_directory, imgf))
+            stack[len(files):] = 0
+            yield stack
+
+    write_OME_tiff(join(output_directory, f'cycle_{rnd}.ome.tif'), tile_stacks(), positions[:len(tiles)],
+                   desc=f'cycle {rnd}', position=position,
+                   tile=tile, compression=compression, subresolutions=subresolutions)
+
+
+def read_planes(dir_path, files):
+    """
+    Yield the planes of a list of TIFF files with read_plane.
+    Corrupted files are reported and skipped, which for a max projection is the same as a black plane.
+    """
+    for file in files:
+        try:
+            yield read_plane(f"{dir_path}/{file}")
+        except Exception:
+            print('Image corrupted, reading black file instead.')
+
+
+def mip_tile_channel(dir_path, channel_files, output_file, image_dimension=[2048, 2048]):
+    """
+    Maximum intensity project the z-planes of a single tile/channel and save the result.
+
+    Parameters:
+    - dir_path: Directory containing the z-plane TIFFs.
+    - channel_files: File names of the z-planes belonging to this tile and channel.
+    - output_file: Path of the projected TIFF to write.
+    - image_dimension: Dimensions of the image (default is [2048, 2048]).
+
+    Returns:
+    - The path of the written file.
+    """
+    max_intensity = max_project_planes(read_planes(dir_path, channel_files))
+    if max_intensity is None:
+        max_intensity = np.zeros(image_dimension, dtype='uint16')
+    tifffile.imwrite(output_file, max_intensity.astype('uint16', copy=False))
+    return output_file
+
+
+def run_mip_jobs(jobs, n_workers=1, worker=mip_tile_channel):
+    """
+    Run a list of projection jobs, serially or over a process pool.
+
+    Parameters:
+    - jobs: List of argument tuples for worker, by default
+            (dir_path, channel_files, output_file, image_dimension) for mip_tile_channel.
+    - n_workers: Number of worker processes. 1 (default) runs in the current process.
+    - worker: Module-level function called as worker(*job). Default is mip_tile_channel.
+    """
+    if n_workers is None or n_workers <= 1:
+        for job in tqdm(jobs):
+            worker(*job)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=tqdm.set_lock, initargs=(tqdm.get_lock(),)) as executor:
+        futures = [executor.submit(worker, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+
 
+def project_leica_tile(dir_path, channel_files, image_dimension=[2048, 2048], output_files=None):
+    """
+    Maximum intensity project all channels of one tile into a single (channels, y, x) uint16 stack.
+
+    Parameters:
+    - dir_path: Directory containing the z-plane TIFFs.
+    - channel_files: One list of z-plane file names per channel, in channel order.
+    - image_dimension: Dimensions of the image if no plane of the tile can be read (default is [2048, 2048]).
+                       Otherwise the stack is sized from the first plane read.
+    - output_files: Optional list of paths, one per channel, to also save every projection as its own TIFF.
 
-def leica_mipping(input_dirs, output_dir_prefix, image_dimension=[2048, 2048], mode=None):
+    Returns:
+    - The projected stack.
+    """
+    stacked = None
+    for n, files in enumerate(channel_files):
+        if stacked is not None:
+            max_project_planes(read_planes(dir_path, files), out=stacked[n])
+            continue
+        projection = max_project_planes(read_planes(dir_path, files))
+        if projection is not None:
+            stacked = np.zeros((len(channel_files), *projection.shape), dtype='uint16')
+            stacked[n] = projection
+    if stacked is None:
+        stacked = np.zeros((len(channel_files), *image_dimension), dtype='uint16')
+    if output_files is not None:
+        for n, output_file in enumerate(output_files):
+            tifffile.imwrite(output_file, stacked[n])
+    return stacked
+
+
+def ordered_pool_map(worker, jobs, n_workers=1, max_pending=None):
+    """
+    Yield worker(*job) for every job, in the order of jobs.
+
+    With n_workers > 1 the jobs run in a process pool. At most max_pending results
+    (default 2 * n_workers) are held at once, so a slow consumer bounds memory use.
+    """
+    if n_workers is None or n_workers <= 1:
+        for job in jobs:
+            yield worker(*job)
+        return
+
+    max_pending = max_pending or 2 * n_workers
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(worker, *job))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def leica_mipping(input_dirs, output_dir_prefix, image_dimension=[2048, 2048], mode=None, n_workers=1,
+                  ome_tiff=False, write_mipped=True):
     """
     Process and MIP (maximum intensity projection) microscopy image files exported from Leica as TIFFs.
 
@@ -86,286 +274,270 @@ def leica_mipping(input_dirs, output_dir_prefix, image_dimension=[2048, 2048], m
     - input_dirs: List of file paths to the input directories.
     - output_dir_prefix: Prefix for the output directory.
     - image_dimension: Dimensions of the image (default is [2048, 2048]).
+    - mode: None for autosaved files, 'exported' for files exported from LasX.
+    - n_workers: Number of processes projecting tiles and channels in parallel. Default is 1 (serial).
+    - ome_tiff: If True, stream the projected tiles of every cycle straight into
+                preprocessing/OME_tiffs/Base_<n>.ome.tiff, with the tile positions from the Leica metadata.
+                This replaces the leica_OME_tiff step. Cycles whose OME-TIFF exists are skipped.
+    - write_mipped: Write the per-channel projections to preprocessing/mipped. Default is True.
+                    Only takes effect together with ome_tiff=True, where it can be turned off.
     """
 
-    # Import necessary libraries
-    from os import listdir
-    from os.path import isfile, join
-    import tifffile
-    from xml.dom import minidom
-    import pandas as pd
-    import numpy as np
-    import os
-    from tifffile import imread
-    from tqdm import tqdm
-    import re
-    import shutil
+    if mode == 'exported':
+        print ('Processing Leica files from export mode')
+        naming, metadata_folder = 'exported', 'MetaData'
+    else:
+        naming, metadata_folder = 'autosaved', 'Metadata'
 
+    # Refactor input directories for compatibility (especially with Linux)
+    refactored_dirs = [dir_path.replace("%20", " ") for dir_path in input_dirs]
 
-    if mode==None:
-        # Refactor input directories for compatibility (especially with Linux)
-        refactored_dirs = [dir_path.replace("%20", " ") for dir_path in input_dirs]
-    
-        # Iterate through each input directory
-        for idx, dir_path in enumerate(refactored_dirs):
-    
-            # Get list of files in the directory
-            files = os.listdir(dir_path)
-            
-            # Filter for TIFF files that are not deconvolved
-            tif_files = [file for file in files if 'dw' not in file and '.tif' in file and '.txt' not in file]
-            
-            # Split filenames to get the regions
-            split_underscore = pd.DataFrame(tif_files)[0].str.split('--', expand=True)
-            unique_regions = list(split_underscore[0].unique())
-    
-            # If the scan is large, it may be divided into multiple regions
-            for region in unique_regions:
-                region_tif_files = [file for file in tif_files if region in file]
-                base_index = str(idx + 1)
-                split_underscore = pd.DataFrame(region_tif_files)[0].str.split('--', expand=True)
-                
-                # Extract tiles information
-                tiles = sorted(split_underscore[1].unique())
-                tiles_df = pd.DataFrame(tiles)
-                tiles_df['indexNumber'] = [int(tile.split('e')[-1]) for tile in tiles_df[0]]
-                tiles_df.sort_values(by=['indexNumber'], ascending=True, inplace=True)
-                tiles_df.drop('indexNumber', axis=1, inplace=True)
-                tiles = list(tiles_df[0])
-                
-                # Extract channels information
-                channels = split_underscore[3].unique()
-                
-                # Determine the output directory based on the region
-                if len(unique_regions) == 1:
-                    output_dir = output_dir_prefix
-                else:
-                    output_dir = f"{output_dir_prefix}_R{region.split('Region')[1].split('_')[0]}"
-                mipped_output_dir = f"{output_dir}/preprocessing/mipped/"
-                
-                # Create directory if it doesn't exist
-                if not os.path.exists(mipped_output_dir):
-                    os.makedirs(mipped_output_dir)
-    
-                for base_idx, base in enumerate(sorted(base_index)):
-                    if not os.path.exists(f"{mipped_output_dir}/Base_{base}"):
-                        os.makedirs(f"{mipped_output_dir}/Base_{base}")
-                    try:
-                        metadata_file = join(dir_path, 'Metadata', [file for file in os.listdir(join(dir_path, 'Metadata')) if region in file][0])
-                        if not os.path.exists(join(mipped_output_dir, f"Base_{base}", 'MetaData')):
-                            os.makedirs(join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                        customcopy(metadata_file, join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                        #shutil.copy(metadata_file, join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                    except FileExistsError:
-                        pass
-    
-                    # Maximum Intensity Projection (MIP) for each tile
-                    for _tile in tqdm(range(len(tiles))):
-                        tile = tiles[_tile]
-                        tile_for_name = re.split('(\d+)', tile)[1]
-                        existing_files = [file for file in os.listdir(f"{mipped_output_dir}/Base_{base}") if str(tile_for_name) in file]
-                        
-                        # Ensure that we don't overwrite existing files
-                        if len(existing_files) < len(channels):
-                            tile_tif_files = [file for file in region_tif_files if f"{tile}--" in file]
-                            for channel_idx, channel in enumerate(sorted(list(channels))):
-                                channel_tif_files = [file for file in tile_tif_files if str(channel) in file]
-                                max_intensity = np.zeros(image_dimension)
-                                for file in channel_tif_files:
-                                    try:
-                                        im_array = imread(f"{dir_path}/{file}")
-                                    except:
-                                        print('Image corrupted, reading black file instead.')
-                                        im_array = np.zeros(image_dimension)
-                                    max_intensity = np.maximum(max_intensity, im_array)
-                                max_intensity = max_intensity.astype('uint16')
-                                tifffile.imwrite(f"{mipped_output_dir}/Base_{base}/Base_{base}_s{tile_for_name}_{channel}", max_intensity)
-    if mode=='exported':
-        print ('Processing Leica files from export mode')
-        # Refactor input directories for compatibility (especially with Linux)
-        refactored_dirs = [dir_path.replace("%20", " ") for dir_path in input_dirs]
-        #print (refactored_dirs)
-    
-        # Iterate through each input directory
-        for idx, dir_path in enumerate(refactored_dirs):
-            # Get list of files in the directory
-            files = os.listdir(dir_path)
-            # Filter for TIFF files that are not deconvolved
-            tif_files = [file for file in files if 'dw' not in file and '.tif' in file and '.txt' not in file]
-            split_underscore = pd.DataFrame(tif_files)[0].str.split('_', expand=True)
-            unique_regions = list(split_underscore[0].unique())
-            for region in unique_regions:
+    # Iterate through each input directory
+    for idx, dir_path in enumerate(refactored_dirs):
+        base = str(idx + 1)
+
+        # Parse the directory listing once, ignoring deconvolved files
+        files = [file for file in os.listdir(dir_path) if 'dw' not in file and '.txt' not in file]
+        catalogue = build_file_catalogue(dir_path, naming, files=files)
+        planes = index_catalogue(catalogue, ['region', 'tile', 'channel'])
+        unique_regions = list(catalogue['region'].unique())
+
+        # If the scan is large, it may be divided into multiple regions
+        for region in unique_regions:
+            if mode == 'exported':
                 print(region)
-                region_tif_files = [file for file in tif_files if region in file]
-                base_index = str(idx + 1)
-                split_underscore = pd.Series(region_tif_files).str.split('_', expand=True)
-                tiles = sorted(split_underscore.iloc[:, -3].unique())
-                tiles_df = pd.DataFrame(tiles)
-                tiles_df['indexNumber'] = [int(tile.split('s')[-1]) for tile in tiles_df[0]]
-                tiles_df.sort_values(by=['indexNumber'], ascending=True, inplace=True)
-                tiles_df.drop(labels='indexNumber', axis=1, inplace=True)
-                tiles = list(tiles_df[0])
-                channels = split_underscore.iloc[:, -1].unique()
-                # Determine the output directory based on the region
-                if len(unique_regions) == 1:
-                    output_dir = output_dir_prefix
-                else:
-                    output_dir = f"{output_dir_prefix}_R{region.split('Region')[1].split('_')[0]}"
-                mipped_output_dir = f"{output_dir}/preprocessing/mipped/"
-                
-                # Create directory if it doesn't exist
-                if not os.path.exists(mipped_output_dir):
-                    os.makedirs(mipped_output_dir)
-    
-                for base_idx, base in enumerate(sorted(base_index)):
-                    if not os.path.exists(f"{mipped_output_dir}/Base_{base}"):
-                        os.makedirs(f"{mipped_output_dir}/Base_{base}")
-                    try:
-                        metadata_file = join(dir_path, 'MetaData', [file for file in os.listdir(join(dir_path, 'MetaData')) if region in file][0])
-                       
-                        if not os.path.exists(join(mipped_output_dir, f"Base_{base}", 'MetaData')):
-                            os.makedirs(join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                        customcopy(metadata_file, join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                        #shutil.copy(metadata_file, join(mipped_output_dir, f"Base_{base}", 'MetaData'))
-                    except FileExistsError:
-                        pass
-    
-                    # Maximum Intensity Projection (MIP) for each tile
-                    for _tile in tqdm(range(len(tiles))):
-                        tile = tiles[_tile]
-                        tile_for_name = re.split('(\d+)', tile)[1]
-                        existing_files = [file for file in os.listdir(f"{mipped_output_dir}/Base_{base}") if str(tile_for_name) in file]
-                        
-                        # Ensure that we don't overwrite existing files
-                        if len(existing_files) < len(channels):
-                            tile_tif_files = [file for file in region_tif_files if f"{tile}_" in file]
-                            for channel_idx, channel in enumerate(sorted(list(channels))):
-                                channel_tif_files = [file for file in tile_tif_files if str(channel) in file]
-                                max_intensity = np.zeros(image_dimension)
-                                for file in channel_tif_files:
-                                    try:
-                                        im_array = imread(f"{dir_path}/{file}")
-                                    except:
-                                        print('Image corrupted, reading black file instead.')
-                                        im_array = np.zeros(image_dimension)
-                                    max_intensity = np.maximum(max_intensity, im_array)
-                                max_intensity = max_intensity.astype('uint16')
-                                tifffile.imwrite(f"{mipped_output_dir}/Base_{base}/Base_{base}_s{tile_for_name}_{channel}", max_intensity)
-    
-    
-                    
+            region_catalogue = catalogue[catalogue['region'] == region]
+            tiles = sorted(region_catalogue['tile'].unique(), key=int)
+            channels = sorted(region_catalogue['channel'].unique())
+
+            # Determine the output directory based on the region
+            if len(unique_regions) == 1:
+                output_dir = output_dir_prefix
+            else:
+                output_dir = f"{output_dir_prefix}_R{region.split('Region')[1].split('_')[0]}"
+            mipped_output_dir = f"{output_dir}/preprocessing/mipped/"
+            base_output_dir = f"{mipped_output_dir}/Base_{base}"
+            metadata_file = join(dir_path, metadata_folder, [file for file in os.listdir(join(dir_path, metadata_folder)) if region in file][0])
+
+            # Create directory if it doesn't exist
+            if write_mipped or not ome_tiff:
+                if not os.path.exists(base_output_dir):
+                    os.makedirs(base_output_dir)
+                try:
+                    if not os.path.exists(join(base_output_dir, 'MetaData')):
+                        os.makedirs(join(base_output_dir, 'MetaData'))
+                    customcopy(metadata_file, join(base_output_dir, 'MetaData'))
+                except FileExistsError:
+                    pass
+
+            if ome_tiff:
+                # Fused mode: project every tile and write it straight into the cycle OME-TIFF
+                ome_output_dir = f"{output_dir}/preprocessing/OME_tiffs"
+                ome_file = f"{ome_output_dir}/Base_{base}.ome.tiff"
+                if os.path.exists(ome_file):
+                    print(f"File {ome_file} already exists. Skipping.")
+                    continue
+                os.makedirs(ome_output_dir, exist_ok=True)
+
+                positions = np.array(leica_tile_positions(metadata_file)).astype(int)
+                tile_jobs = []
+                for tile in tiles:
+                    output_files = None
+                    if write_mipped:
+                        output_files = [f"{base_output_dir}/Base_{base}_s{tile}_{channel}.tif" for channel in channels]
+                    tile_jobs.append((dir_path,
+                                      [planes.get((region, tile, channel), []) for channel in channels],
+                                      image_dimension,
+                                      output_files))
+                write_OME_tiff(ome_file, ordered_pool_map(project_leica_tile, tile_jobs, n_workers=n_workers), positions)
+                continue
+
+            # Ensure that we don't overwrite existing files
+            existing_files = build_file_catalogue(base_output_dir, 'mipped').groupby('tile').size()
+
+            # Maximum Intensity Projection (MIP) for each tile
+            mip_jobs = []
+            for tile in tiles:
+                if existing_files.get(tile, 0) < len(channels):
+                    for channel in channels:
+                        mip_jobs.append((dir_path,
+                                         planes.get((region, tile, channel), []),
+                                         f"{base_output_dir}/Base_{base}_s{tile}_{channel}.tif",
+                                         image_dimension))
+            run_mip_jobs(mip_jobs, n_workers=n_workers)
+
+
+def leica_tile_positions(metadata_file):
+    """
+    Read the stage positions of the tiles from a Leica metadata file (.xml/.xlif with TileScanInfo).
+
+    Args:
+    - metadata_file: Path to the metadata file.
+
+    Returns:
+    DataFrame with the x and y position of every tile, in pixels from the top-left tile.
+    """
+    mydoc = minidom.parse(metadata_file)
+    x = []
+    y = []
+    for elem in mydoc.getElementsByTagName('Tile'):
+        x.append(float(elem.attributes['PosX'].value))
+        y.append(float(elem.attributes['PosY'].value))
+    df = pd.DataFrame({'x': x, 'y': y})
+    df['x'] =((df.x-np.min(df.x))/.000000321) + 1
+    df['y'] =((df.y-np.min(df.y))/.000000321) + 1
+    return df
+
+
+def downsample_stack(stacked, factor=2):
+    """
+    Bin a (channels, y, x) stack by factor in y and x, for the sub-resolutions of a pyramidal OME-TIFF.
+    Rows and columns that do not fill a whole bin are dropped.
+    """
+    c, h, w = stacked.shape
+    h, w = h // factor * factor, w // factor * factor
+    binned = stacked[:, :h, :w].reshape(c, h // factor, factor, w // factor, factor).mean(axis=(2, 4))
+    return binned.astype(stacked.dtype)
 
 
+def write_OME_tiff(output_file, tile_stacks, positions, pixel_size=0.1625, tile=None, desc=None, position=None,
+                   compression=None, subresolutions=0):
+    """
+    Write tiles into a multi-series OME-TIFF that Ashlar can read, one series per tile.
 
+    Every tile is written with a single call from its (channels, y, x) uint16 buffer. The
+    tiles are deliberately not written with contiguous=True: tifffile would then append
+    them to the previous series and Ashlar would see one image instead of a mosaic.
 
+    Args:
+    - output_file: Path of the OME-TIFF. The file is written as <output_file>.part and
+      renamed when complete, so an existing output_file is always a finished one.
+    - tile_stacks: Iterable of (channels, y, x) arrays, in the same order as positions.
+      Each array is written before the next one is requested, so the iterable may reuse a buffer.
+    - positions: Array of (x, y) tile positions in pixels.
+    - pixel_size: Pixel size in microns. Default is 0.1625.
+    - tile: Optional (y, x) TIFF tile shape to store the pages tiled instead of in strips, e.g. (512, 512).
+    - desc, position: Label and line of the progress bar, to tell cycles written in parallel apart.
+    - compression: Optional lossless compression, e.g. 'zstd', 'lzw' or 'zlib'. A horizontal
+      predictor is added. zstd and lzw need the imagecodecs package.
+    - subresolutions: Number of 2x binned sub-resolutions stored with every tile. Default is 0.
+    """
+    options = {'tile': tile}
+    if compression is not None:
+        options.update(compression=compression, predictor=True)
+
+    part_file = output_file + '.part'
+    with tifffile.TiffWriter(part_file, bigtiff=True, ome=True) as tif:
+        for position, stacked in tqdm(zip(positions, tile_stacks), total=len(positions),
+                                     desc=desc, position=position, leave=position is None):
+            metadata = {
+                            'Pixels': {
+                                'PhysicalSizeX': pixel_size,
+                                'PhysicalSizeXUnit': 'µm',
+                                'PhysicalSizeY': pixel_size,
+                                'PhysicalSizeYUnit': 'µm'
+                            },
+                            'Plane': {
+                                'PositionX': [position[0]*pixel_size]*stacked.shape[0],
+                                'PositionY': [position[1]*pixel_size]*stacked.shape[0]
+                            }
+                        }
+            stacked = stacked.astype('uint16', copy=False)
+            tif.write(stacked, metadata=metadata, subifds=subresolutions or None, **options)
+            for level in range(subresolutions):
+                stacked = downsample_stack(stacked)
+                tif.write(stacked, subfiletype=1, metadata=None, **options)
+    os.replace(part_file, output_file)
 
 
-def leica_OME_tiff(directory_base, output_directory):
+def read_tile_stacks(directory, catalogue, tiles, channels):
+    """
+    Yield one (channels, y, x) uint16 stack per tile from the projected TIFFs of a cycle folder.
+
+    A single buffer, shaped after the first image of the catalogue, is allocated once and
+    refilled for every tile; channels missing for a tile are left black.
+
+    Args:
+    - directory: Cycle folder with the projected TIFFs.
+    - catalogue: File catalogue of directory (build_file_catalogue with the 'mipped' naming).
+    - tiles: Tiles to read, in output order.
+    - channels: Channels to read, in output order.
+    """
+    tile_files = index_catalogue(catalogue, ['tile', 'channel'])
+    with tifffile.TiffFile(join(directory, catalogue['file'].iloc[0])) as tif:
+        image_shape = tif.pages[0].shape
+    stacked = np.empty((len(channels), *image_shape), dtype='uint16')
+
+    for tile in tiles:
+        for n, channel in enumerate(channels):
+            image_files = tile_files.get((tile, channel))
+            if image_files is None:
+                stacked[n] = 0
+                continue
+            try:
+                stacked[n] = read_plane(join(directory, image_files[0]))
+            except (IndexError, ValueError):
+                print(f'Could not read {image_files[0]}, writing a black image instead.')
+                stacked[n] = 0
+        yield stacked
+
+
+def leica_OME_tiff(directory_base, output_directory, n_workers=1, tile=None, compression=None, subresolutions=0):
     """
     Convert Leica TIFF files to OME-TIFF format.
     
     Args:
     - directory_base: Base directory containing the TIFF files.
     - output_directory: Directory to save the converted OME-TIFF files.
+    - n_workers: Number of cycles to convert in parallel worker processes. Default is 1.
+    - tile, compression, subresolutions: Storage of the OME-TIFFs, see write_OME_tiff. The default
+      is uncompressed strips without a pyramid, e.g. tile=(512, 512), compression='zstd' to save space.
     
     Returns:
     None. Writes the OME-TIFF images to the designated output directory.
     """
-    
-    import tifffile
-    import numpy as np
-    import os
-    from os.path import join
-    import tifffile
-    import os
-    from os import listdir
-    import pandas as pd
-    import numpy as np
-    from xml.dom import minidom
-    from pathlib import Path
-    from tqdm import tqdm
-
     folders = os.listdir(directory_base)
     folders = [f for f in folders if f != ".DS_Store"]
     
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
-        
-    for folder in folders:
-        exported_directory = join(directory_base,folder)
-        onlyfiles = listdir(exported_directory)
-        onlytifs =  [k for k in onlyfiles if '.tif' in k]
-        onlyfiles_df = pd.DataFrame(onlytifs)
-        onlyfiles_split_tiles = onlyfiles_df[0].str.split('_s',expand=True)
-        onlyfiles_split_channel = onlyfiles_split_tiles[1].str.split('_',expand=True)
-
-        tiles = list(np.unique(onlyfiles_split_tiles[1].str.split('_',expand=True)[0]))
-        tiles_df=pd.DataFrame(tiles)
-        tiles_df['indexNumber'] = [int(i.split('e')[-1]) for i in tiles_df[0]]
-        # Perform sort of the rows
-        tiles_df.sort_values(by = ['indexNumber'], ascending = [True], inplace = True)
-        # Deletion of the added column
-        tiles_df.drop('indexNumber', axis=1, inplace = True)
-        tiles = list(tiles_df[0])
-        channels = list(np.unique(onlyfiles_split_channel[1]))
-        rounds = list(np.unique(onlyfiles_split_tiles[0]))
-        
-        
-        metadatafiles = listdir(join(exported_directory, 'MetaData'))
-        metadatafiles =  [k for k in metadatafiles if 'IOManagerConfiguation.xlif' not in k]
-
-        for p, meta in enumerate(metadatafiles):
-            print(meta)
-            mydoc = minidom.parse(join(exported_directory, 'MetaData',meta) )
-            tile =[]
-            x =[]
-            y =[]
-            items = mydoc.getElementsByTagName('Tile')
-            for el, elem in enumerate(items):
-                tile.append(el)
-                x.append(float(elem.attributes['PosX'].value))
-                y.append(float(elem.attributes['PosY'].value))
-            unique_tiles = list(np.unique(tile))
-            x_reformatted = (x[:len(unique_tiles)])    
-            y_reformatted = (y[:len(unique_tiles)])     
-            dictionary = {'x': x_reformatted, 'y': y_reformatted}  
-
-            df = pd.DataFrame(dictionary)
-            df['x'] =((df.x-np.min(df.x))/.000000321) + 1
-            df['y'] =((df.y-np.min(df.y))/.000000321) + 1
-            positions = np.array(df).astype(int)
-            df.to_csv(directory_base +'/'+ folder + '/coords.csv')
-            
-        with tifffile.TiffWriter((output_directory +'/'+ folder + '.ome.tiff'), bigtiff=True) as tif:
-            for i in tqdm(range(len(tiles))):
-                position = positions[i]
-                tile = tiles[i]
 
-                tile_filtered = [k for k in onlytifs if 's'+tile+'_' in k]
-                tile_filtered =  [k for k in tile_filtered if '._' not in k]
+    jobs = [(directory_base, folder, output_directory, i + 1 if n_workers > 1 else None,
+             tile, compression, subresolutions)
+            for i, folder in enumerate(folders)]
+    run_mip_jobs(jobs, n_workers, worker=leica_cycle_OME_tiff)
 
-                stacked = np.empty((len(channels), 2048, 2048))
-                for n,image_file in enumerate(sorted(tile_filtered)):
-                    try: 
-                        image_int = tifffile.imread(join(exported_directory,image_file))
-                    except IndexError: 
-                        image_int = np.empty((2048, 2048))
-                    stacked[n] = image_int.astype('uint16')
-                pixel_size = 0.1625
-                metadata = {
-                                'Pixels': {
-                                    'PhysicalSizeX': pixel_size,
-                                    'PhysicalSizeXUnit': 'µm',
-                                    'PhysicalSizeY': pixel_size,
-                                    'PhysicalSizeYUnit': 'µm'
-                                },
-                                'Plane': {
-                                    'PositionX': [position[0]*pixel_size]*stacked.shape[0],
-                                    'PositionY': [position[1]*pixel_size]*stacked.shape[0]
-                                }
 
-                            }
-                tif.write(stacked.astype('uint16'),metadata=metadata)
+def leica_cycle_OME_tiff(directory_base, folder, output_directory, position=None,
+                         tile=None, compression=None, subresolutions=0):
+    """
+    Convert a single cycle folder of Leica TIFF files to <output_directory>/<folder>.ome.tiff. Used by leica_OME_tiff.
+
+    Args:
+    - directory_base: Base directory containing the cycle folders.
+    - folder: Name of the cycle folder, e.g. Base_1.
+    - output_directory: Directory to save the OME-TIFF file.
+    - position: Line of the progress bar, when several cycles are converted at once.
+    - tile, compression, subresolutions: Storage of the OME-TIFF, see write_OME_tiff.
+    """
+    exported_directory = join(directory_base,folder)
+    catalogue = build_file_catalogue(exported_directory, 'mipped')
+    tiles = sorted(catalogue['tile'].unique(), key=int)
+    channels = sorted(catalogue['channel'].unique())
+
+    metadatafiles = os.listdir(join(exported_directory, 'MetaData'))
+    metadatafiles =  [k for k in metadatafiles if 'IOManagerConfiguation.xlif' not in k]
+
+    for p, meta in enumerate(metadatafiles):
+        print(meta)
+        df = leica_tile_positions(join(exported_directory, 'MetaData', meta))
+        positions = np.array(df).astype(int)
+        df.to_csv(directory_base +'/'+ folder + '/coords.csv')
+
+    write_OME_tiff(output_directory +'/'+ folder + '.ome.tiff',
+                   read_tile_stacks(exported_directory, catalogue, tiles, channels),
+                   positions, desc=folder, position=position,
+                   tile=tile, compression=compression, subresolutions=subresolutions)
 
 
 def ashlar_wrapper(
@@ -384,10 +556,21 @@ def ashlar_wrapper(
     dfp=False,
     plates=False,
     quiet=False,
-    version=False
+    version=False,
+    n_threads=None,
+    alignment_file=None,
+    reuse_alignment=True
 ):
     """
     Wrapper for Ashlar alignment and mosaicking, with keyword-only parameter calls.
+
+    n_threads is the thread budget of the alignment: the number of workers of the scipy FFTs and,
+    if threadpoolctl is installed, the size of the BLAS/OpenMP thread pools. None (default) leaves
+    the libraries at their own defaults. Use ashlar_regions to align several regions at once.
+
+    The tile positions of every cycle are saved to alignment_file, by default
+    <output>/ashlar_alignment.json, and reused by later runs on the same files with the same
+    alignment parameters, see ashlar_single. Set reuse_alignment=False to align again.
     """
     ashlar.configure_terminal()
     filepaths = files
@@ -431,39 +614,276 @@ def ashlar_wrapper(
     if pyramid: mosaic_args['tile_size'] = tile_size
     if not quiet: mosaic_args['verbose'] = True
 
-    try:
-        if plates:
-            return ashlar.process_plates(
-                filepaths=filepaths,
-                output_dir=output_path,
-                filename_format=filename_format,
-                flip_x=flip_x,
-                flip_y=flip_y,
-                ffp_paths=ffp_paths,
-                dfp_paths=dfp_paths,
-                aligner_args=aligner_args,
-                mosaic_args=mosaic_args,
-                pyramid=pyramid,
-                quiet=quiet
-            )
-        else:
-            mosaic_fmt = str(output_path / filename_format)
-            return ashlar.process_single(
-                filepaths=filepaths,
-                output_path_format=mosaic_fmt,
-                flip_x=flip_x,
-                flip_y=flip_y,
-                ffp_paths=ffp_paths,
-                dfp_paths=dfp_paths,
-                barrel_correction=0,
-                aligner_args=aligner_args,
-                mosaic_args=mosaic_args,
-                pyramid=pyramid,
-                quiet=quiet
-            )
-    except ashlar.ProcessingError as e:
-        ashlar.print_error(str(e))
-        return 1
+    with thread_budget(n_threads):
+        try:
+            if plates:
+                return ashlar.process_plates(
+                    filepaths=filepaths,
+                    output_dir=output_path,
+                    filename_format=filename_format,
+                    flip_x=flip_x,
+                    flip_y=flip_y,
+                    ffp_paths=ffp_paths,
+                    dfp_paths=dfp_paths,
+                    aligner_args=aligner_args,
+                    mosaic_args=mosaic_args,
+                    pyramid=pyramid,
+                    quiet=quiet
+                )
+            else:
+                mosaic_fmt = str(output_path / filename_format)
+                return ashlar_single(
+                    filepaths=filepaths,
+                    output_path_format=mosaic_fmt,
+                    flip_x=flip_x,
+                    flip_y=flip_y,
+                    ffp_paths=ffp_paths,
+                    dfp_paths=dfp_paths,
+                    aligner_args=aligner_args,
+                    mosaic_args=mosaic_args,
+                    pyramid=pyramid,
+                    quiet=quiet,
+                    alignment_file=alignment_file or str(output_path / 'ashlar_alignment.json'),
+                    reuse_alignment=reuse_alignment
+                )
+        except ashlar.ProcessingError as e:
+            ashlar.print_error(str(e))
+            return 1
+
+
+def ashlar_single(filepaths, output_path_format, flip_x, flip_y, ffp_paths, dfp_paths, aligner_args,
+                  mosaic_args, pyramid, quiet, alignment_file=None, reuse_alignment=True):
+    """
+    Align and mosaic the cycles of one region like ashlar.process_single, with a cached alignment.
+
+    The edge shifts and tile positions of every cycle are saved to alignment_file (JSON), keyed by
+    the fingerprints of the input files (see path_fingerprint) and the alignment parameters. When
+    the key matches on a later run the saved positions are used and the cycles go straight to
+    mosaicking, so output_channels, pyramid settings or flat-field profiles can be changed without
+    aligning again.
+
+    Args:
+    - filepaths ... quiet: As for ashlar.process_single, without barrel correction.
+    - alignment_file: Path of the alignment sidecar. None disables the cache.
+    - reuse_alignment: Use a matching alignment_file instead of aligning. Default is True.
+
+    Returns:
+    - 0, as ashlar.process_single.
+    """
+    key = stage_key({'files': list(filepaths), 'flip_x': flip_x, 'flip_y': flip_y,
+                     'aligner_args': {k: v for k, v in aligner_args.items() if k != 'verbose'}},
+                    path_fingerprint(filepaths))
+    saved = None
+    if alignment_file and reuse_alignment and os.path.exists(alignment_file):
+        with open(alignment_file) as f:
+            saved = json.load(f)
+        if saved.get('key') != key:
+            saved = None
+
+    mosaic_args = mosaic_args.copy()
+    writer_args = {}
+    if pyramid:
+        writer_args['tile_size'] = mosaic_args.pop('tile_size', None)
+
+    aligners = []
+    if saved is not None:
+        if not quiet:
+            print(f"Reusing the alignment saved in {alignment_file}")
+        for filepath, cycle in zip(filepaths, saved['cycles']):
+            reader = ashlar.build_reader(filepath)
+            ashlar.process_axis_flip(reader, flip_x, flip_y)
+            # Mosaic only needs the reader, metadata and positions of an aligner
+            aligners.append(SimpleNamespace(reader=reader, metadata=reader.metadata,
+                                            positions=np.array(cycle['positions'])))
+        mshape = tuple(saved['mosaic_shape'])
+    else:
+        if not quiet:
+            print("Stitching and registering input images")
+            print('Cycle 0:')
+            print('    reading %s' % filepaths[0])
+        reader = ashlar.build_reader(filepaths[0])
+        ashlar.process_axis_flip(reader, flip_x, flip_y)
+        ea_args = aligner_args.copy()
+        layer_args = {k: v for k, v in aligner_args.items() if k not in ('alpha', 'max_error')}
+        if len(filepaths) == 1:
+            ea_args['do_make_thumbnail'] = False
+        edge_aligner = ashlar.reg.EdgeAligner(reader, **ea_args)
+        edge_aligner.run()
+        mshape = edge_aligner.mosaic_shape
+        aligners.append(edge_aligner)
+
+        for cycle, filepath in enumerate(filepaths[1:], 1):
+            if not quiet:
+                print('Cycle %d:' % cycle)
+                print('    reading %s' % filepath)
+            reader = ashlar.build_reader(filepath)
+            ashlar.process_axis_flip(reader, flip_x, flip_y)
+            layer_aligner = ashlar.reg.LayerAligner(reader, edge_aligner, **layer_args)
+            layer_aligner.run()
+            aligners.append(layer_aligner)
+
+        # Disable reader caching to save memory during mosaicing and writing.
+        edge_aligner.reader = edge_aligner.reader.reader
+
+        if alignment_file:
+            alignment = {'key': key, 'mosaic_shape': list(mshape),
+                         'cycles': [{'file': filepath, 'shifts': aligner.shifts.tolist(),
+                                     'positions': aligner.positions.tolist()}
+                                    for filepath, aligner in zip(filepaths, aligners)]}
+            with open(alignment_file + '.part', 'w') as f:
+                json.dump(alignment, f)
+            os.replace(alignment_file + '.part', alignment_file)
+
+    mosaics = []
+    for cycle, aligner in enumerate(aligners):
+        mosaic_args_final = mosaic_args.copy()
+        if ffp_paths:
+            mosaic_args_final['ffp_path'] = ffp_paths[cycle]
+        if dfp_paths:
+            mosaic_args_final['dfp_path'] = dfp_paths[cycle]
+        mosaics.append(ashlar.reg.Mosaic(aligner, mshape, **mosaic_args_final))
+
+    if not quiet:
+        print()
+        print(f"Merging tiles and writing to {output_path_format}")
+    writer_class = ashlar.reg.PyramidWriter if pyramid else ashlar.reg.TiffListWriter
+    writer = writer_class(mosaics, output_path_format, verbose=not quiet, **writer_args)
+    writer.run()
+
+    return 0
+
+
+@contextmanager
+def thread_budget(n_threads=None):
+    """
+    Run the enclosed code with at most n_threads scipy FFT workers and, if threadpoolctl is
+    installed, BLAS/OpenMP threads. None leaves the libraries at their own defaults.
+    """
+    if n_threads is None:
+        yield
+        return
+    import scipy.fft
+    with scipy.fft.set_workers(n_threads):
+        with (threadpool_limits(limits=n_threads) if threadpool_limits is not None else nullcontext()):
+            yield
+
+
+def threads_per_worker(n_workers=1):
+    """Default thread budget of each of n_workers concurrent workers: the CPUs shared out evenly, at least 1."""
+    return max(1, (os.cpu_count() or 1) // max(n_workers, 1))
+
+
+def ashlar_regions(region_files, outputs, n_workers=1, n_threads=None, **ashlar_args):
+    """
+    Align and stitch independent regions with ashlar_wrapper, several at once in separate processes.
+
+    This is for stitching regions outside preprocessing_main_leica, e.g. the regions of CZI or LIF
+    data processed step by step in the notebooks. preprocessing_main_leica runs each region's whole
+    pipeline in its own process instead (parallel_regions), with the same thread budget (ashlar_threads).
+
+    Args:
+    - region_files: One list of cycle OME-TIFFs per region.
+    - outputs: One output directory per region.
+    - n_workers: Number of regions aligned at once. Default is 1 (one region after the other).
+    - n_threads: Thread budget of every region, see ashlar_wrapper. Default is the number of
+      CPUs divided by n_workers, so the regions together use the whole machine.
+    - ashlar_args: Further keyword arguments of ashlar_wrapper, the same for every region.
+
+    Returns:
+    - List of the ashlar_wrapper return values, in the order of the regions.
+    """
+    if n_threads is None:
+        n_threads = threads_per_worker(n_workers)
+    worker = partial(ashlar_wrapper, n_threads=n_threads, **ashlar_args)
+    jobs = [(files, output) for files, output in zip(region_files, outputs)]
+    return list(tqdm(ordered_pool_map(worker, jobs, n_workers=n_workers), total=len(jobs), desc='regions'))
+
+
+def sample_tile_stacks(OME_tiff, n_samples=50, bin_factor=8, seed=0):
+    """
+    Read a random sample of the tiles of a cycle OME-TIFF, binned as they are read.
+
+    Only one full-resolution tile is held in memory at a time, the sample itself is
+    (n_samples, channels, y / bin_factor, x / bin_factor) float32.
+
+    Returns:
+    - The binned sample and the (y, x) shape of the full-resolution tiles.
+    """
+    with tifffile.TiffFile(OME_tiff) as tif:
+        n_tiles = len(tif.series)
+        picked = np.random.default_rng(seed).choice(n_tiles, size=min(n_samples, n_tiles), replace=False)
+        samples = []
+        for i in sorted(picked):
+            stacked = tif.series[i].asarray()
+            tile_shape = stacked.shape[-2:]
+            stacked = stacked.reshape(-1, *tile_shape).astype(np.float32)
+            samples.append(downsample_stack(stacked, bin_factor))
+    return np.stack(samples), tile_shape
+
+
+def smooth_profile(binned, tile_shape, sigma=2):
+    """Smooth binned (channels, y, x) profiles and resize them to the full tile shape."""
+    return np.stack([cv2.resize(cv2.GaussianBlur(channel, (0, 0), sigma), tile_shape[::-1],
+                                interpolation=cv2.INTER_LINEAR) for channel in binned])
+
+
+def write_profile(output_file, profile):
+    """
+    Save a (channels, y, x) illumination profile as a float32 TIFF in the layout Ashlar reads.
+    Ashlar expects single channel profiles as 2D images and 3 or 4 channel profiles channel-last.
+    """
+    if len(profile) == 1:
+        profile = profile[0]
+    elif len(profile) in (3, 4):
+        profile = np.moveaxis(profile, 0, -1)
+    tifffile.imwrite(output_file, profile.astype(np.float32), photometric='minisblack')
+    return output_file
+
+
+def estimate_illumination_profiles(OME_tiffs, output_directory, n_samples=50, bin_factor=8, sigma=2,
+                                   dark=False, dark_percentile=1, seed=0):
+    """
+    Estimate flat-field (and dark-field) profiles of cycle OME-TIFFs, to pass to ashlar_wrapper as ffp and dfp.
+
+    Illumination varies smoothly over a tile, so the profiles are estimated at 1 / bin_factor of the
+    tile resolution from a random sample of tiles. Spots and tissue are in different places on
+    every tile, so the per-pixel median over the sample follows the illumination. The dark-field is
+    the per-pixel dark_percentile of the sample and is subtracted before the flat-field median. It
+    is only meaningful when the sample includes tiles without tissue, e.g. around the section.
+    The flat-field is normalised to a mean of 1.
+
+    Args:
+    - OME_tiffs: List of cycle OME-TIFFs, as written by leica_OME_tiff or zen_OME_tiff.
+    - output_directory: Folder to write <cycle>_ffp.tif (and <cycle>_dfp.tif) to.
+    - n_samples: Number of tiles sampled per cycle. Default is 50.
+    - bin_factor: Binning of the sampled tiles. Default is 8.
+    - sigma: Gaussian smoothing of the binned profiles, in binned pixels. Default is 2.
+    - dark: Also estimate dark-field profiles. Default is False.
+    - dark_percentile: Percentile of the sample used as dark-field. Default is 1.
+    - seed: Seed of the tile sampling. Default is 0.
+
+    Returns:
+    - Lists of the flat-field and the dark-field profile paths, one per cycle. The dark-field list is
+      empty if dark is False.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    ffp_paths, dfp_paths = [], []
+    for OME_tiff in tqdm(OME_tiffs, desc='illumination profiles'):
+        name = os.path.basename(OME_tiff).split('.ome.tif')[0]
+        samples, tile_shape = sample_tile_stacks(OME_tiff, n_samples, bin_factor, seed)
+
+        if dark:
+            dfp = smooth_profile(np.percentile(samples, dark_percentile, axis=0).astype(np.float32),
+                                 tile_shape, sigma)
+            samples -= downsample_stack(dfp, bin_factor)
+            dfp_paths.append(write_profile(join(output_directory, name + '_dfp.tif'), dfp))
+
+        ffp = smooth_profile(np.median(samples, axis=0), tile_shape, sigma)
+        mean = ffp.mean(axis=(1, 2), keepdims=True)
+        # channels without signal are left uncorrected
+        ffp = np.where(mean > 0, ffp / np.where(mean > 0, mean, 1), 1)
+        ffp_paths.append(write_profile(join(output_directory, name + '_ffp.tif'), ffp))
+    return ffp_paths, dfp_paths
 
 
 def reshape_split(image: np.ndarray, kernel_size: tuple):
@@ -491,7 +911,154 @@ def reshape_split(image: np.ndarray, kernel_size: tuple):
     
 
 
-def tile_stitched_images(image_path,outpath, tile_dim=2000, file_type = 'tif', old_stiched_name = False):
+def stitched_tiles(image, tile_dim):
+    """
+    Yield (row, column, tile) for the tile_dim x tile_dim tiles of a 2D image, row by row.
+
+    Tiles are views of image, so a memory-mapped image is read one tile at a time. Only the
+    tiles on the bottom and right edge are copied into a zero padded tile_dim x tile_dim buffer,
+    which gives the same tiles as padding the whole image and splitting it with reshape_split.
+    """
+    nrows = math.ceil(image.shape[0] / tile_dim)
+    ncols = math.ceil(image.shape[1] / tile_dim)
+    for i in range(nrows):
+        for j in range(ncols):
+            tile = image[i*tile_dim:(i+1)*tile_dim, j*tile_dim:(j+1)*tile_dim]
+            if tile.shape != (tile_dim, tile_dim):
+                padded = np.zeros((tile_dim, tile_dim), dtype=image.dtype)
+                padded[:tile.shape[0], :tile.shape[1]] = tile
+                tile = padded
+            yield i, j, tile
+
+
+def stitched_image_name(image_file, old_stiched_name=False):
+    """
+    Return the 0-based cycle and channel, as strings, of a stitched TIFF file name.
+
+    Args:
+    - image_file (str): File name, e.g. Base_1_stitched-1.tif with old names, or Base1_0.tif.
+    - old_stiched_name (bool): Flag to handle old naming convention. Default is False.
+    """
+    if old_stiched_name == True:
+        cycle = str(int(''.join(filter(str.isdigit, image_file.split('_')[1])))-1)
+        channel = str(int(''.join(filter(str.isdigit, image_file.split('-')[1])))-1)
+    else:
+        cycle = ''.join(filter(str.isdigit, image_file.split('_')[0]))
+        channel = ''.join(filter(str.isdigit, image_file.split('_')[1]))
+    return cycle, channel
+
+
+def create_tile_store(store_path, rounds, channels, image_shape, tile_dim, dtype='uint16'):
+    """
+    Create an empty OME-NGFF (0.4) Zarr store for the retiled stitched images.
+
+    The store holds a single array, <store_path>/0, with axes (round, channel, y, x) and one
+    chunk per tile. The y and x size is image_shape rounded up to whole tiles, so edge tiles
+    are zero padded as in the tile TIFFs. The group attribute 'tiles' records the round
+    names (e.g. Base_1_stitched), the 1-based channel numbers, tile_dim and the image shape.
+
+    Args:
+    - store_path (str): Path of the store, e.g. <outpath>/tiles.zarr. An existing store is overwritten.
+    - rounds (list): Round names, in round order.
+    - channels (list): Channel numbers, in channel order.
+    - image_shape (tuple): (y, x) size of the stitched images.
+    - tile_dim (int): Dimension of the tiles and chunks.
+    - dtype (str): Data type of the images. Default is 'uint16'.
+    """
+    import zarr
+
+    # NGFF 0.4 is stored as Zarr v2, which zarr>=3 only writes when asked to
+    zarr_format = {'zarr_format': 2} if int(zarr.__version__.split('.')[0]) >= 3 else {}
+    group = zarr.open_group(store_path, mode='w', **zarr_format)
+    shape = (len(rounds), len(channels),
+             math.ceil(image_shape[0] / tile_dim) * tile_dim, math.ceil(image_shape[1] / tile_dim) * tile_dim)
+    zarr.open_array(store_path + '/0', mode='w', shape=shape, chunks=(1, 1, tile_dim, tile_dim), dtype=dtype,
+                    fill_value=0, dimension_separator='/', **zarr_format)
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': os.path.basename(store_path),
+        'axes': [{'name': 'round'}, {'name': 'channel', 'type': 'channel'},
+                 {'name': 'y', 'type': 'space'}, {'name': 'x', 'type': 'space'}],
+        'datasets': [{'path': '0', 'coordinateTransformations': [{'type': 'scale', 'scale': [1, 1, 1, 1]}]}],
+    }]
+    group.attrs['tiles'] = {'rounds': list(rounds), 'channels': [int(c) for c in channels],
+                            'tile_dim': tile_dim, 'shape': [int(n) for n in image_shape]}
+
+
+def tile_stitched_image(image_path, image_file, outpath, tile_dim=2000, file_type='tif', old_stiched_name=False,
+                        write_threads=1, tile_store=None):
+    """
+    Tile a single stitched image into <outpath>/Base_<cycle>_stitched-<channel>/tile<k>.tif. Used by tile_stitched_images.
+
+    Stitched TIFFs are memory-mapped when they are stored uncompressed, and tiles are cut only as they
+    are written, so peak memory is about 2 * write_threads tiles.
+
+    Args:
+    - image_path (str): Directory containing the stitched images.
+    - image_file (str): File name of the stitched image.
+    - outpath (str): Directory to save the tiled images.
+    - tile_dim (int): Dimension for tiling. Default is 2000.
+    - file_type (str): Type of the image file. Default is 'tif'.
+    - old_stiched_name (bool): Flag to handle old naming convention. Default is False.
+    - write_threads (int): Number of threads writing the tiles. Default is 1.
+    - tile_store (str): Path of a store made by create_tile_store to write the tiles to, instead of TIFF files.
+
+    Returns:
+    - Lists of the x and y position of every tile, or None if a .mat file has no image.
+    """
+    try:
+        if file_type == 'mat':
+            image = mat73.loadmat(image_path +'/'+ image_file)['I']
+            cycle = ''.join(filter(str.isdigit, image_file.split('_')[1]))
+            channel = ''.join(filter(str.isdigit, image_file.split('_')[2].split('-')[1].split('.')[0]))
+        else:
+            image = read_plane(image_path +'/'+ image_file)
+            cycle, channel = stitched_image_name(image_file, old_stiched_name)
+            if old_stiched_name == True:
+                print('old names')
+                print(cycle)
+                print(channel)
+    except KeyError:
+        return None
+
+    print('tiling: ' + image_file)
+
+    if tile_store is None:
+        directory = outpath +'/'+'Base_'+str(int(cycle)+1)+'_stitched-'+str(int(channel)+1)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        def write_tile(count, i, j, tile):
+            tifffile.imwrite(directory + '/' +'tile'+str(count)+'.tif', tile)
+    else:
+        import zarr
+        store = zarr.open_group(tile_store, mode='r+')
+        array = store['0']
+        r = store.attrs['tiles']['rounds'].index('Base_'+str(int(cycle)+1)+'_stitched')
+        c = store.attrs['tiles']['channels'].index(int(channel)+1)
+
+        def write_tile(count, i, j, tile):
+            array[r, c, i*tile_dim:(i+1)*tile_dim, j*tile_dim:(j+1)*tile_dim] = tile
+
+    x = []
+    y = []
+    write_threads = max(write_threads, 1)
+    with ThreadPoolExecutor(max_workers=write_threads) as executor:
+        # Tiles are cut as the writers catch up, at most 2 * write_threads of them are held at once
+        pending = deque()
+        for count, (i, j, tile) in enumerate(stitched_tiles(image, tile_dim), start=1):
+            x.append(j*tile_dim)
+            y.append(i*tile_dim)
+            pending.append(executor.submit(write_tile, count, i, j, tile))
+            if len(pending) >= 2 * write_threads:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    return x, y
+
+
+def tile_stitched_images(image_path,outpath, tile_dim=2000, file_type = 'tif', old_stiched_name = False,
+                         n_workers = 1, write_threads = 4, output_format = 'tif'):
 
     """
     Tiles stitched images from a directory and saves them with a specific naming convention.
@@ -502,6 +1069,11 @@ def tile_stitched_images(image_path,outpath, tile_dim=2000, file_type = 'tif', o
     - tile_dim (int): Dimension for tiling. Default is 2000.
     - file_type (str): Type of the image file. Default is 'tif'.
     - old_stitched_naming (bool): Flag to handle old naming convention. Default is False.
+    - n_workers (int): Number of stitched images tiled at once in worker processes. Default is 1.
+    - write_threads (int): Number of threads writing the tiles of each image. Default is 4.
+    - output_format (str): 'tif' (default) writes Base_<cycle>_stitched-<channel>/tile<k>.tif files.
+                           'zarr' writes all tiles to one OME-NGFF store, <output_directory>/tiles.zarr,
+                           see create_tile_store. Needs the zarr package and stitched TIFF files.
     """
     
     if not os.path.exists(outpath):
@@ -515,47 +1087,31 @@ def tile_stitched_images(image_path,outpath, tile_dim=2000, file_type = 'tif', o
     else: 
         images =  [k for k in images if '.tif' in k] 
 
-    for image_file in sorted(images):
-        try: 
-            if file_type == 'mat':
-                image = mat73.loadmat(image_path +'/'+ image_file)['I']
-                cycle = ''.join(filter(str.isdigit, image_file.split('_')[1]))
-                channel = ''.join(filter(str.isdigit, image_file.split('_')[2].split('-')[1].split('.')[0]))
-            else:
-                if old_stiched_name == True:
-                    print('old names')
-                    image = tifffile.imread(image_path +'/'+ image_file)
-                    cycle = str(int(''.join(filter(str.isdigit, image_file.split('_')[1])))-1)
-                    channel = str(int(''.join(filter(str.isdigit, image_file.split('-')[1])))-1)
-                    print(cycle)
-                    print(channel)
-                else: 
-                    image = tifffile.imread(image_path +'/'+ image_file)
-                    cycle = ''.join(filter(str.isdigit, image_file.split('_')[0]))
-                    channel = ''.join(filter(str.isdigit, image_file.split('_')[1]))
-
-           
-            
-            print('tiling: ' + image_file)
-            
-            image_pad = cv2.copyMakeBorder( image, top = 0, bottom =math.ceil(image.shape[0]/tile_dim)*tile_dim-image.shape[0], left =0, right = math.ceil(image.shape[1]/tile_dim)*tile_dim-image.shape[1], borderType = cv2.BORDER_CONSTANT)
-            image_split = reshape_split(image_pad,(tile_dim,tile_dim))
-            nrows, ncols, dim1, dim2 = image_split.shape
-            x = []
-            y = []
-            directory = outpath +'/'+'Base_'+str(int(cycle)+1)+'_stitched-'+str(int(channel)+1) 
-            if not os.path.exists(directory):
-                os.makedirs(directory) 
-            count = 0
-            for i in range(nrows):
-                for j in range(ncols):
-                    count = count+1                
-                    x.append(j*tile_dim)
-                    y.append(i*tile_dim)
-                    
-                    tifffile.imwrite(directory + '/' +'tile'+str(count)+'.tif',image_split[i][j])
-        except KeyError:
-            continue
+    tile_store = None
+    if output_format == 'zarr':
+        if file_type == 'mat':
+            raise ValueError("output_format='zarr' needs stitched TIFF files, not .mat files.")
+        names = [stitched_image_name(image_file, old_stiched_name) for image_file in images]
+        shapes = []
+        for image_file in images:
+            with tifffile.TiffFile(image_path +'/'+ image_file) as tif:
+                shapes.append(tif.pages[0].shape)
+                dtype = tif.pages[0].dtype
+        tile_store = outpath + '/tiles.zarr'
+        create_tile_store(tile_store,
+                          rounds=['Base_'+str(r+1)+'_stitched' for r in sorted({int(c) for c, _ in names})],
+                          channels=[ch+1 for ch in sorted({int(ch) for _, ch in names})],
+                          image_shape=np.max(shapes, axis=0),
+                          tile_dim=tile_dim,
+                          dtype=dtype)
+    elif output_format != 'tif':
+        raise ValueError(f"output_format should be 'tif' or 'zarr', not {output_format!r}.")
+
+    jobs = [(image_path, image_file, outpath, tile_dim, file_type, old_stiched_name, write_threads, tile_store)
+            for image_file in sorted(images)]
+    for positions in ordered_pool_map(tile_stitched_image, jobs, n_workers):
+        if positions is not None:
+            x, y = positions
                 
     tile_pos = pd.DataFrame()
     tile_pos['x'] = x
@@ -565,16 +1121,288 @@ def tile_stitched_images(image_path,outpath, tile_dim=2000, file_type = 'tif', o
     return
     
     
+def path_fingerprint(paths):
+    """
+    Fingerprint files and directories from their names, sizes and modification times.
+
+    Hashing the pixel data of a whole experiment would take as long as processing it, so the
+    fingerprint changes when a file is added, removed, rewritten or touched, not on content alone.
+
+    Args:
+    - paths: List of files or directories. Directories are walked recursively.
+
+    Returns:
+    - Dictionary mapping every path to a sha256 hex digest, or None if the path does not exist.
+    """
+    fingerprints = {}
+    for path in paths:
+        if not os.path.exists(path):
+            fingerprints[path] = None
+            continue
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = sorted(join(root, f) for root, _, names in os.walk(path) for f in names)
+        digest = hashlib.sha256()
+        for file in files:
+            stat = os.stat(file)
+            digest.update(f'{os.path.relpath(file, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+        fingerprints[path] = digest.hexdigest()
+    return fingerprints
+
+
+def file_stats(paths):
+    """Return {file: (size, mtime_ns)} for the files in paths. Directories are walked recursively."""
+    stats = {}
+    for path in paths:
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = [join(root, f) for root, _, names in os.walk(path) for f in names]
+        for file in files:
+            stat = os.stat(file)
+            stats[file] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def peak_rss():
+    """Peak resident memory (MB) of this process and of its finished child processes, None where unsupported."""
+    if resource is None:
+        return {'peak_rss_MB': None, 'peak_rss_children_MB': None}
+    scale = 1e6 if sys.platform == 'darwin' else 1e3  # ru_maxrss is in bytes on macOS, kB on Linux
+    return {'peak_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            'peak_rss_children_MB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+@contextmanager
+def instrument_stage(stage, inputs=(), outputs=(), report=None):
+    """
+    Record wall time, I/O, throughput and peak memory of the code run in the with-block.
+
+    The bytes read are the size of inputs and the bytes written the size of the files created or
+    changed in outputs, so work done in worker processes is included. tiles defaults to the
+    number of files written; set record['tiles'] in the with-block to count something else.
+    Peak RSS is the high-water mark of the process (and its finished workers) at the end of the stage.
+
+    Args:
+    - stage: Name of the stage in the report.
+    - inputs: Files and directories the stage reads.
+    - outputs: Files and directories the stage writes.
+    - report: Optional list the record is appended to, also when the stage fails.
+
+    Yields:
+    - The record dictionary, filled in when the block exits.
+    """
+    record = {'stage': stage, 'status': 'done', 'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+    before = file_stats(outputs)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        wall_time = time.perf_counter() - start
+        written = [size for file, (size, mtime) in file_stats(outputs).items() if before.get(file) != (size, mtime)]
+        bytes_read = sum(size for size, _ in file_stats(inputs).values())
+        record.setdefault('tiles', len(written))
+        record.update(wall_time_s=wall_time,
+                      bytes_read=bytes_read,
+                      bytes_written=sum(written),
+                      read_MB_s=bytes_read / 1e6 / wall_time if wall_time else None,
+                      write_MB_s=sum(written) / 1e6 / wall_time if wall_time else None,
+                      tiles_per_s=record['tiles'] / wall_time if wall_time else None,
+                      **peak_rss())
+        if report is not None:
+            report.append(record)
+
+
+def write_run_report(report, report_file):
+    """Write the records of instrument_stage to <report_file>.json and <report_file>.csv."""
+    with open(report_file + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    pd.DataFrame(report).to_csv(report_file + '.csv', index=False)
+
+
+def read_manifest(manifest_file):
+    """Read a pipeline manifest written by run_stage, or return an empty one."""
+    if not os.path.exists(manifest_file):
+        return {'stages': {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def update_manifest(manifest_file, stage, record, lock):
+    """Replace the record of one stage in the manifest. The file is rewritten atomically under lock."""
+    with lock:
+        manifest = read_manifest(manifest_file)
+        manifest['stages'][stage] = record
+        with open(manifest_file + '.part', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_file + '.part', manifest_file)
+
+
+def stage_key(params, input_fingerprints):
+    """Hash the parameters and input fingerprints of a pipeline stage."""
+    return hashlib.sha256(json.dumps({'params': params, 'inputs': input_fingerprints},
+                                     sort_keys=True, default=str).encode()).hexdigest()
+
+
+def run_stage(manifest_file, stage, run, params, inputs, outputs, lock, resume=True, report=None, tiles=None):
+    """
+    Run one pipeline stage, unless the manifest shows it already finished with the same inputs and parameters.
+
+    A stage is skipped when its manifest record is 'done', the parameters and the fingerprints of
+    the inputs are unchanged and all outputs exist. The inputs are fingerprinted once the stage
+    has finished, as some stages add files next to their inputs (leica_OME_tiff writes coords.csv).
+    The record is set to 'running', then 'done' or 'failed' (with the error), so the manifest
+    always shows where a run stopped.
+
+    Args:
+    - manifest_file: Path of the JSON manifest.
+    - stage: Name of the stage in the manifest, e.g. 'R1/ashlar'.
+    - run: Function called without arguments to run the stage.
+    - params: JSON serialisable parameters of the stage.
+    - inputs: Files and directories the stage reads.
+    - outputs: Files and directories the stage writes.
+    - lock: Lock shared by all processes writing the manifest.
+    - resume: Skip finished stages. Default is True. With False the stage always runs.
+    - report: Optional list to append the instrument_stage record of the stage to.
+    - tiles: Number of tiles the stage processes, for the report. Default is the number of files written.
+    """
+    input_fingerprints = path_fingerprint(inputs)
+    key = stage_key(params, input_fingerprints)
+    record = read_manifest(manifest_file)['stages'].get(stage)
+    if (resume and record is not None and record['status'] == 'done' and record['key'] == key
+            and all(os.path.exists(path) for path in outputs)):
+        print(f'{stage}: already done, skipping')
+        if report is not None:
+            report.append({'stage': stage, 'status': 'skipped'})
+        return
+
+    record = {'status': 'running', 'key': key, 'params': params, 'inputs': input_fingerprints,
+              'outputs': {path: None for path in outputs}, 'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+    update_manifest(manifest_file, stage, record, lock)
+    try:
+        with instrument_stage(stage, inputs, outputs, report) if report is not None else nullcontext({}) as stats:
+            if tiles is not None:
+                stats['tiles'] = tiles
+            run()
+    except Exception as error:
+        record.update(status='failed', error=repr(error), finished=time.strftime('%Y-%m-%d %H:%M:%S'))
+        update_manifest(manifest_file, stage, record, lock)
+        raise
+    input_fingerprints = path_fingerprint(inputs)
+    record.update(status='done', key=stage_key(params, input_fingerprints), inputs=input_fingerprints,
+                  outputs=path_fingerprint(outputs), finished=time.strftime('%Y-%m-%d %H:%M:%S'))
+    update_manifest(manifest_file, stage, record, lock)
+
+
+def preprocess_leica_region(path, manifest_file, lock, region, align_channel=4, tile_dimension=6000,
+                            make_OME_tiffs=True, n_workers=1, ashlar_threads=None, illumination=False,
+                            resume=True, report=None):
+    """
+    Run the OME-TIFF, Ashlar and retiling stages of preprocessing_main_leica for one region.
+
+    Args:
+    - path (str): Output directory of the region.
+    - manifest_file (str): Path of the pipeline manifest.
+    - lock: Lock shared by all processes writing the manifest.
+    - region (str): Name of the region in the manifest, e.g. 'R1'.
+    - align_channel (int): Channel to use for alignment. Default is 4.
+    - tile_dimension (int): Dimension for tiling. Default is 6000.
+    - make_OME_tiffs (bool): Run leica_OME_tiff. False when the mipping step already wrote the OME-TIFFs.
+    - n_workers (int): Number of processes used for building the cycle OME-TIFFs and retiling. Default is 1.
+    - ashlar_threads (int): Thread budget of the Ashlar alignment, see ashlar_wrapper. Default is None.
+    - illumination (bool): Estimate flat-field profiles with estimate_illumination_profiles and
+                           correct the stitched images with them. Default is False.
+    - resume (bool): Skip stages that already finished, see run_stage. Default is True.
+    - report (list): Optional list (or multiprocessing manager list) to append the instrument_stage
+                     records of the stages to, as each stage ends.
+
+    Returns:
+    - report.
+    """
+    mipped_dir = path+'/preprocessing/mipped/'
+    OME_tiffs_dir = os.path.join(path, 'preprocessing', 'OME_tiffs')
+    stitched_dir = path+'/preprocessing/stitched/'
+    tiles_dir = path+'/preprocessing/ReslicedTiles/'
+    profiles_dir = os.path.join(path, 'preprocessing', 'illumination')
+
+    def list_OME_tiffs():
+        return natsorted([
+            os.path.join(OME_tiffs_dir, fname)
+            for fname in os.listdir(OME_tiffs_dir)
+            if '.ome.tif' in fname and not fname.endswith('.part')
+        ])
+
+    # create leica OME_tiffs (already written by the mipping step in fused mode)
+    if make_OME_tiffs:
+        run_stage(manifest_file, region + '/OME_tiffs',
+                  lambda: leica_OME_tiff(directory_base = mipped_dir,
+                                         output_directory = OME_tiffs_dir + '/',
+                                         n_workers = n_workers),
+                  params={}, inputs=[mipped_dir], outputs=[OME_tiffs_dir], lock=lock, resume=resume,
+                  report=report, tiles=sum('.tif' in f for f in file_stats([mipped_dir])))
+
+    # estimate flat-field profiles
+    if illumination:
+        run_stage(manifest_file, region + '/illumination',
+                  lambda: estimate_illumination_profiles(list_OME_tiffs(), profiles_dir),
+                  params={}, inputs=[OME_tiffs_dir], outputs=[profiles_dir], lock=lock, resume=resume,
+                  report=report)
+
+    # align and stitch images
+    def align_and_stitch():
+        OME_tiffs = list_OME_tiffs()
+        ffp = False
+        if illumination:
+            ffp = [os.path.join(profiles_dir, os.path.basename(f).split('.ome.tif')[0] + '_ffp.tif')
+                   for f in OME_tiffs]
+        ashlar_wrapper(files = OME_tiffs,
+                       output = stitched_dir,
+                       align_channel=align_channel,
+                       n_threads=ashlar_threads,
+                       ffp=ffp)
+    run_stage(manifest_file, region + '/ashlar', align_and_stitch,
+              params={'align_channel': align_channel, 'illumination': illumination},
+              inputs=[OME_tiffs_dir] + ([profiles_dir] if illumination else []), outputs=[stitched_dir],
+              lock=lock, resume=resume, report=report)
+
+    # retile stitched images
+    run_stage(manifest_file, region + '/retile',
+              lambda: tile_stitched_images(image_path = stitched_dir,
+                                           outpath = tiles_dir,
+                                           tile_dim=tile_dimension,
+                                           n_workers = n_workers),
+              params={'tile_dimension': tile_dimension}, inputs=[stitched_dir], outputs=[tiles_dir],
+              lock=lock, resume=resume, report=report)
+    return report
+
+
 def preprocessing_main_leica(input_dirs, 
                             output_location,
                             regions_to_process = 2, 
                             align_channel = 4, 
                             tile_dimension = 6000, 
                             mip = True,
-                            mode = None):
+                            mode = None,
+                            n_workers = 1,
+                            fused = False,
+                            write_mipped = False,
+                            resume = True,
+                            parallel_regions = 1,
+                            ashlar_threads = None,
+                            illumination = False,
+                            report = False):
     """
     Main function to preprocess Leica microscopy images.
 
+    Every stage (mipping, then OME-TIFFs, Ashlar and retiling per region) is recorded in a manifest,
+    <output_location>_manifest.json, with the fingerprints of its inputs, its parameters and its
+    outputs. When the function is run again, finished stages are skipped, so an interrupted run
+    resumes at the stage and region where it stopped.
+
     Args:
     - input_dirs (str): Directories containing input images.
     - output_location (str): Base output directory.
@@ -582,69 +1410,84 @@ def preprocessing_main_leica(input_dirs,
     - align_channel (int): Channel to use for alignment. Default is 4.
     - tile_dimension (int): Dimension for tiling. Default is 6000.
     - mip (bool): Flag to perform maximum intensity projection. Default is True. Use false for pre-mipped images
+    - mode (str): None for autosaved files, 'exported' for files exported from LasX.
+    - n_workers (int): Number of processes used for mipping, building the cycle OME-TIFFs and retiling. Default is 1.
+    - fused (bool): Write the projected tiles straight into the cycle OME-TIFFs instead of going
+                    through per-channel TIFFs and leica_OME_tiff. Default is False.
+    - write_mipped (bool): In fused mode, also write the per-channel TIFFs to preprocessing/mipped. Default is False.
+    - resume (bool): Skip the stages the manifest shows as finished. Default is True. Use False to rerun everything.
+    - parallel_regions (int): Number of regions processed at once in worker processes, each with all its
+                              stages, including Ashlar (see ashlar_regions for stitching regions on their own).
+                              Default is 1.
+    - ashlar_threads (int): Thread budget of every region's Ashlar alignment, see ashlar_wrapper.
+                            Default is the number of CPUs divided by parallel_regions.
+    - illumination (bool): Estimate flat-field profiles from the cycle OME-TIFFs of every region and
+                           correct the stitched images with them. Default is False.
+    - report (bool): Write the wall time, bytes read and written, throughput and peak memory of
+                     every stage to <output_location>_run_report.json and .csv. Default is False.
     """
-    
+    manifest_file = output_location.rstrip('/') + '_manifest.json'
+    run_report = [] if report else None
+
+    if regions_to_process > 1:
+        paths = [output_location +'_R'+str(i+1) for i in range(regions_to_process)]
+    else:
+        paths = [output_location]
+
+    # Regions processed in parallel share a manager lock on the manifest instead, see below
+    lock = threading.Lock()
+
     # Maximum Intensity Projection
     if mip == True:
-        leica_mipping(input_dirs=input_dirs, output_dir_prefix = output_location)
+        mipping_outputs = [path + '/preprocessing/' + folder for path in paths
+                           for folder in (['OME_tiffs'] if fused else []) + (['mipped'] if write_mipped or not fused else [])]
+        run_stage(manifest_file, 'mipping',
+                  lambda: leica_mipping(input_dirs=input_dirs, 
+                                        output_dir_prefix = output_location, 
+                                        mode = mode,
+                                        n_workers = n_workers,
+                                        ome_tiff = fused,
+                                        write_mipped = write_mipped or not fused),
+                  params={'mode': mode, 'fused': fused, 'write_mipped': write_mipped},
+                  inputs=list(input_dirs), outputs=mipping_outputs, lock=lock, resume=resume, report=run_report)
     else: 
         print('not mipping')
-        
-    if regions_to_process > 1:
-        for i in range(regions_to_process):
-            path = output_location +'_R'+str(i+1)
-            
-            # create leica OME_tiffs
-            leica_OME_tiff(directory_base = path+'/preprocessing/mipped/', 
-                                            output_directory = path+'/preprocessing/OME_tiffs/',
-                                            mode = mode)
-            
-            # align and stitch images
-            OME_tiffs_dir = os.path.join(path, 'preprocessing', 'OME_tiffs')
-            OME_tiffs = natsorted([
-                os.path.join(OME_tiffs_dir, fname)
-                for fname in os.listdir(OME_tiffs_dir)
-            ])
-            ashlar_wrapper(files = OME_tiffs, 
-                                            output = path+'/preprocessing/stitched/', 
-                                            align_channel=align_channel)
-            
-            # retile stitched images
-            tile_stitched_images(image_path = path+'/preprocessing/stitched/',
-                                    outpath = path+'/preprocessing/ReslicedTiles/', 
-                                    tile_dim=tile_dimension)
-
-    
-    else: 
-        path = output_location
-
-        # create leica OME_tiffs
-        leica_OME_tiff(directory_base = path+'/preprocessing/mipped/', 
-                                        output_directory = path+'/preprocessing/OME_tiffs/')
 
-        # align and stitch images
-        OME_tiffs_dir = os.path.join(path, 'preprocessing', 'OME_tiffs')
-        OME_tiffs = natsorted([
-            os.path.join(OME_tiffs_dir, fname)
-            for fname in os.listdir(OME_tiffs_dir)
-        ])
+    if ashlar_threads is None:
+        ashlar_threads = threads_per_worker(parallel_regions)
 
-        ashlar_wrapper(files = OME_tiffs, 
-                                        output = path+'/preprocessing/stitched/', 
-                                        align_channel=align_channel)
+    def region_jobs(lock, region_report):
+        return [(path, manifest_file, lock, 'R'+str(i+1), align_channel, tile_dimension, not (mip and fused),
+                 n_workers, ashlar_threads, illumination, resume, region_report)
+                for i, path in enumerate(paths)]
 
-        # retile stitched images
-        tile_stitched_images(image_path = path+'/preprocessing/stitched/',
-                                outpath = path+'/preprocessing/ReslicedTiles/', 
-                                tile_dim=tile_dimension)
+    # The regions append to the report as they go, so the stages of a failed region are reported too
+    try:
+        if parallel_regions > 1:
+            # The manager is shut down once the pool is, also when a region fails
+            with multiprocessing.Manager() as manager:
+                region_report = manager.list() if report else None
+                try:
+                    with ProcessPoolExecutor(max_workers=parallel_regions) as executor:
+                        futures = [executor.submit(preprocess_leica_region, *job)
+                                   for job in region_jobs(manager.Lock(), region_report)]
+                        for future in as_completed(futures):
+                            future.result()
+                finally:
+                    # Once the pool has shut down, the regions still running when one failed have finished
+                    if report:
+                        run_report.extend(region_report)
+        else:
+            for job in region_jobs(lock, run_report):
+                preprocess_leica_region(*job)
+    finally:
+        if report:
+            write_run_report(run_report, output_location.rstrip('/') + '_run_report')
     return
 
 
-
-
-
-
-def process_czi(input_file, outpath, mip=True, cycle=0, tile_size_x=2048, tile_size_y=2048):
+def process_czi(input_file, outpath, mip=True, cycle=0, tile_size_x=2048, tile_size_y=2048, n_threads=1, max_prefetch=None,
+                resume=True, checksum=False):
     """
     Process CZI files, apply maximum intensity projection (if specified), 
     and create an associated XML with metadata.
@@ -656,6 +1499,16 @@ def process_czi(input_file, outpath, mip=True, cycle=0, tile_size_x=2048, tile_s
     - cycle: Int to specify the cycle number. Default is 0.
     - tile_size_x: Size of the tile in X dimension. Default is 2048.
     - tile_size_y: Size of the tile in Y dimension. Default is 2048.
+    - n_threads: Number of threads writing tiles. With n_threads > 1 a reader thread decompresses and
+                 projects the next tiles from the CZI while the current ones are written.
+                 Default is 1 (read, project and write one tile after the other).
+    - max_prefetch: Number of projected tiles the reader may read ahead. Default is n_threads. Tiles are
+                    projected plane by plane as they are read, so together with the tiles being written
+                    at most max_prefetch + n_threads 2D projections (and one z-plane) are held in memory.
+    - resume: If True (default), tiles whose projection already exists with its full size are not read
+              from the CZI again, so an interrupted job continues where it stopped.
+    - checksum: If True, a .sha256 sidecar is written next to every tile, and on resume
+                tiles are only skipped when their content matches it.
     
     Returns:
     - A string indicating that processing is complete.
@@ -686,108 +1539,239 @@ def process_czi(input_file, outpath, mip=True, cycle=0, tile_size_x=2048, tile_s
     except:
         msize=0 
     ssize = dimensions[0]['S'][1]
+    zsize = dimensions[0]['Z'][1] if 'Z' in dimensions[0] else None
 
     # Check if mip is True and cycle is not zero.
     if mip and cycle != 0:
-        # Initialize placeholders for metadata.
-        Bxcoord = []
-        Bycoord = []
+        # Tile positions, read once per tile for all channels.
+        tile_x, tile_y = czi_tile_positions(czi, msize)
         Btile_index = []
         filenamesxml = []
         Bchindex = []
 
-        # Loop through each mosaic tile and each channel.
-        for m in tqdm(range(0, msize)):
-            for ch in range (0, chsize):
-                # Get metadata and image data for the current tile and channel.
-                meta = czi.get_mosaic_tile_bounding_box(M=m, Z=0, C=ch)
-                img, shp = czi.read_image(M=m, C=ch)
-                
-                # Apply maximum intensity projection.
-                IM_MAX = np.max(img, axis=3)
-                IM_MAX = np.squeeze(IM_MAX, axis=(0,1,2,3))
-                
-                # Construct filename for the processed image.
-                n = str(0)+str(m+1) if m < 9 else str(m+1)
-                filename = 'Base_' + str(cycle) + '_c' + str(ch+1) + 'm' + str(n) + '_ORG.tif'
-                
-                # Save the processed image.
-                
-                tifffile.imwrite(outpath + filename, IM_MAX.astype('uint16'))
-                
-                # Append metadata to the placeholders.
-                Bchindex.append(ch)
-                Bxcoord.append(meta.x)
-                Bycoord.append(meta.y)
-                Btile_index.append(m)
-                filenamesxml.append(filename)
+        # Construct the filename of every processed image.
+        tiles = []
+        for m in range(0, msize):
+            n = str(0)+str(m+1) if m < 9 else str(m+1)
+            for ch in range(0, chsize):
+                tiles.append((m, ch, 'Base_' + str(cycle) + '_c' + str(ch+1) + 'm' + str(n) + '_ORG.tif'))
+
+        # Tiles projected by an earlier run are not read again.
+        todo = tiles
+        if resume and msize:
+            meta = czi.get_mosaic_tile_bounding_box(M=0, Z=0, C=0)
+            todo = [tile for tile in tiles if not tile_done(outpath + tile[2], meta.w * meta.h * 2, checksum)]
+            if len(todo) < len(tiles):
+                print(f"{len(tiles) - len(todo)} of {len(tiles)} tiles already processed. Skipping.")
+
+        def read_tiles():
+            # Project the z-planes of the current tile and channel as they are read, one subblock at a time,
+            # so that only the running maximum of a tile is held in memory.
+            for m, ch, filename in todo:
+                yield filename, max_project_planes(czi_planes(czi, m, ch, zsize))
+
+        with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as executor:
+            pending = deque()
+            tile_reader = read_tiles() if n_threads <= 1 else prefetch(read_tiles(), max_prefetch or n_threads)
+
+            # Loop through each mosaic tile and each channel left to process.
+            for filename, projection in tqdm(tile_reader, total=len(todo)):
+                # Save the maximum intensity projection.
+                if n_threads <= 1:
+                    write_tile(outpath + filename, projection, checksum)
+                else:
+                    pending.append(executor.submit(write_tile, outpath + filename, projection, checksum))
+                    if len(pending) >= n_threads:
+                        pending.popleft().result()
+            for future in pending:
+                future.result()
+
+        # Append metadata of every tile, processed now or by an earlier run, to the placeholders.
+        for m, ch, filename in tiles:
+            Bchindex.append(ch)
+            Btile_index.append(m)
+            filenamesxml.append(filename)
+
+        # Save the ExportDocument XML, with XY coordinates relative to the top-left tile.
+        write_czi_export_xml(outpath + 'Base_' + str(cycle) + '_info.xml', filenamesxml, Btile_index, Bchindex,
+                             tile_x[Btile_index], tile_y[Btile_index], tile_size_x, tile_size_y)
 
-        # Adjust the XY coordinates to be relative.
-        nBxcord = [x - min(Bxcoord) for x in Bxcoord]
-        nBycord = [y - min(Bycoord) for y in Bycoord]
-        
-        # Create a DataFrame to organize the collected metadata.
-        metadatalist = pd.DataFrame({
-            'Btile_index': Btile_index, 
-            'Bxcoord': nBxcord, 
-            'Bycoord': nBycord, 
-            'filenamesxml': filenamesxml,
-            'channelindex': Bchindex
-        })
-        
-        metadatalist = metadatalist.sort_values(by=['channelindex','Btile_index'])
-        metadatalist.reset_index(drop=True)
+    return "Processing complete."
 
-        # Initialize the XML document structure.
-        export_doc = ET.Element('ExportDocument')
-        
-        # Populate the XML document with metadata.
-        for index, row in metadatalist.iterrows():
-            image_elem = ET.SubElement(export_doc, 'Image')
-            filename_elem = ET.SubElement(image_elem, 'Filename')
-            filename_elem.text = row['filenamesxml']
-            
-            bounds_elem = ET.SubElement(image_elem, 'Bounds')
-            bounds_elem.set('StartX', str(row['Bxcoord']))
-            bounds_elem.set('SizeX', str(tile_size_x))
-            bounds_elem.set('StartY', str(row['Bycoord']))
-            bounds_elem.set('SizeY', str(tile_size_y))
-            bounds_elem.set('StartZ', '0')
-            bounds_elem.set('StartC', '0')
-            bounds_elem.set('StartM', str(row['Btile_index']))
-            
-            zoom_elem = ET.SubElement(image_elem, 'Zoom')
-            zoom_elem.text = '1'
+def file_sha256(path):
+    """Return the sha256 hex digest of a file, read in 16 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-        
-        # Save the constructed XML document to a file.
-        xml_str = ET.tostring(export_doc)
-        with open(outpath + 'Base_' + str(cycle) + '_info.xml', 'wb') as f:
-            f.write(xml_str)
 
-    return "Processing complete."
+def write_tile(output_file, image, checksum=False):
+    """
+    Save a projected tile as a uint16 TIFF.
+
+    The tile is written as <output_file>.part and renamed when complete, so an interrupted job
+    never leaves a truncated output_file behind. With checksum=True the sha256 of the file is
+    also written to an <output_file>.sha256 sidecar, in the format of sha256sum.
+    """
+    part_file = output_file + '.part'
+    tifffile.imwrite(part_file, image.astype('uint16', copy=False))
+    os.replace(part_file, output_file)
+    if checksum:
+        with open(output_file + '.sha256', 'w') as f:
+            f.write(f'{file_sha256(output_file)}  {os.path.basename(output_file)}\n')
+    return output_file
+
+
+def tile_done(output_file, nbytes, checksum=False):
+    """
+    Check if a tile written by write_tile can be skipped on a resumed run.
+
+    Parameters:
+    - output_file: Path of the tile.
+    - nbytes: Size of the tile pixels in bytes. Smaller files are truncated and written again.
+    - checksum: If True, the tile also needs an <output_file>.sha256 sidecar matching its content.
+    """
+    if not os.path.exists(output_file) or os.path.getsize(output_file) < nbytes:
+        return False
+    if not checksum:
+        return True
+    try:
+        with open(output_file + '.sha256') as f:
+            return f.read().split()[0] == file_sha256(output_file)
+    except (OSError, IndexError):
+        return False
+
+
+def prefetch(iterable, max_prefetch=2):
+    """
+    Iterate over iterable in a background thread, up to max_prefetch items ahead of the consumer.
+
+    The items are produced in a single thread, so iterable may use objects that are not thread-safe.
+    An exception raised by iterable is raised again in the consumer.
+    """
+    items = queue.Queue(maxsize=max(max_prefetch, 1))
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as error:
+            items.put((done, error))
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # unblock the reader if the consumer stopped early, then let it finish
+        stop.set()
+        while reader.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def czi_planes(czi, m, ch, zsize=None):
+    """
+    Yield the 2D z-planes of one CZI mosaic tile and channel, one subblock read at a time.
+    If zsize is None the file has no Z dimension and a single plane is yielded.
+    """
+    if zsize is None:
+        img, shp = czi.read_image(M=m, C=ch)
+        yield img.reshape(img.shape[-2:])
+        return
+    for z in range(zsize):
+        img, shp = czi.read_image(M=m, C=ch, Z=z)
+        yield img.reshape(img.shape[-2:])
+
+
+def lif_z_planes(image, m=0, c=0, t=0):
+    """
+    Yield the z-planes of one tile/channel of a LIF image, memory-mapped straight from the file.
+
+    The plane offsets follow the layout readlif uses in LifImage.get_frame, but the raw buffers
+    are mapped with numpy instead of going through a PIL image per plane. Images that readlif
+    cannot describe with simple frame offsets (non x/y display dims, file objects) fall back
+    to get_iter_z.
+
+    Parameters:
+    - image: readlif LifImage.
+    - m, c, t: Mosaic tile, channel and time point.
+    """
+    if tuple(image.display_dims) != (1, 2) or not isinstance(image.filename, (str, bytes, os.PathLike)):
+        for z_frame in image.get_iter_z(t=t, c=c, m=m):
+            yield np.asarray(z_frame)
+        return
+
+    dtype = np.dtype('uint8') if image.bit_depth[0] == 8 else np.dtype('<u2')
+    shape = (image.dims.y, image.dims.x)
+    block_offset, block_len = image.offsets
+
+    # Number of planes stored in the image block, as in LifImage._get_item
+    n_items = image.channels * int(np.prod([n for d, n in image.dims_n.items() if d not in image.display_dims]))
+    plane_len = block_len // n_items
+
+    for z in range(image.nz):
+        if image.channel_as_second_dim:
+            item = t * image.channels * image.nz + c * image.nz + z
+        else:
+            item = t * image.channels * image.nz + z * image.channels + c
+        item += m * image.channels * image.nz * image.nt
+
+        if block_len == 0:
+            # truncated image, readlif reads these as black planes
+            yield np.zeros(shape, dtype=dtype)
+        else:
+            yield np.memmap(image.filename, dtype=dtype, mode='r', offset=block_offset + plane_len * item, shape=shape)
+
 
 def max_project_z(image, m, c):
-    # Initialize a list to hold all Z-plane data
-    z_planes = []
+    # Fold each Z-plane into the projection as it is read from the file, no z-stack is built
+    return max_project_planes(lif_z_planes(image, m=m, c=c))
+
 
-    # Iterate over all Z-planes for the given timepoint and channel
-    for z_frame in image.get_iter_z(m=m, c=c):
-        # Convert the Pillow Image to a NumPy array
-        z_data = np.array(z_frame)
-        #print (z_data.shape)
-        z_planes.append(z_data)
+@lru_cache(maxsize=None)
+def open_lif_image(lif_path, index):
+    """Open image number index of a LIF file, parsing its XML header once per process."""
+    return LifFile(lif_path).get_image(index)
 
-    # Stack all Z-planes along a new axis
-    z_stack = np.stack(z_planes, axis=0)
-    #print (z_stack.shape)
 
-    # Perform maximum intensity projection along the Z-axis (axis=0)
-    max_projection = np.max(z_stack, axis=0)
+def mip_lif_tile(lif_path, index, m, c, output_path, checksum=False):
+    """
+    Maximum intensity project one tile/channel of a LIF image and save it with write_tile.
+    The image is reopened from its path, so the job can run in a worker process.
+    """
+    max_projected = max_project_z(open_lif_image(lif_path, index), m, c)  # (y, x)
+    return write_tile(output_path, max_projected, checksum=checksum)
 
-    return max_projection
+def lif_mipping(lif_path, output_folder, cycle, n_workers=1, resume=True, checksum=False):
+    """
+    Maximum intensity project the tiles of a .lif file (auto-saved or exported from LasX).
 
-def lif_mipping(lif_path, output_folder, cycle):
+    Parameters:
+    - lif_path: Path to the .lif file.
+    - output_folder: Output folder. If the file holds several images, one _R<n> subfolder is made per image (region).
+    - cycle: Number of the ISS cycle contained in the file.
+    - n_workers: Number of processes projecting tiles in parallel. Default is 1 (serial).
+    - resume: If True (default), tiles whose projection already exists with its full size are skipped,
+              so an interrupted job continues where it stopped.
+    - checksum: If True, a .sha256 sidecar is written next to every tile, and on resume
+                tiles are only skipped when their content matches it.
+    """
     file = LifFile(lif_path)
     
     os.makedirs(output_folder, exist_ok=True)
@@ -820,33 +1804,23 @@ def lif_mipping(lif_path, output_folder, cycle):
             image_name = image_name.replace('/', '_')
             tree.write(f"{mipped_subfolder}/MetaData/{image_name}.xml", encoding="utf-8", xml_declaration=True)
             print(f"Processing Image {index}: {image_name}")
-            image = file.get_image(index)
             channels = image_dict['channels']
             dims = image_dict['dims']
 
             if dims.m == 1:
                 print("Single tile imaging.")
+
+            mip_jobs = []
+            for m in range(dims.m):  # Loop through each tile
                 for c in range(channels):  # Loop through each channel
-                    max_projected = max_project_z(image, c)  # (y, x)
                     # Clean filename
                     clean_name = f"Base_{cycle}"
-                    filename = f"{clean_name}_s00_C0{c}.tif"
+                    filename = f"{clean_name}_s{m:02d}_C0{c}.tif"
                     output_path = os.path.join(mipped_subfolder, filename)
-
-                    tifffile.imwrite(output_path, max_projected.astype(np.uint16))
-                    print(f"Saved: {output_path}")
-
-            else:
-                for m in range(dims.m):  # Loop through each tile
-                    for c in range(channels):  # Loop through each channel
-                        max_projected = max_project_z(image,m, c)  # (y, x)
-                        # Clean filename
-                        clean_name = f"Base_{cycle}"
-                        filename = f"{clean_name}_s{m:02d}_C0{c}.tif"
-                        output_path = os.path.join(mipped_subfolder, filename)
-
-                        tifffile.imwrite(output_path, max_projected.astype(np.uint16))
-                        print(f"Saved: {output_path}")
+                    if resume and tile_done(output_path, dims.x * dims.y * 2, checksum):
+                        continue
+                    mip_jobs.append((lif_path, index, m, c, output_path, checksum))
+            run_mip_jobs(mip_jobs, n_workers=n_workers, worker=mip_lif_tile)
     else:
         mipped_subfolder = f"{output_folder}/preprocessing/mipped/Base_{cycle}"
         os.makedirs(mipped_subfolder, exist_ok=True)
@@ -872,33 +1846,23 @@ def lif_mipping(lif_path, output_folder, cycle):
             tree.write(f"{mipped_subfolder}/MetaData/{image_name}.xml", encoding="utf-8", xml_declaration=True)
             
             print(f"Processing Image {index}: {image_name}")
-            image = file.get_image(index)
             channels = image_dict['channels']
             dims = image_dict['dims']
 
             if dims.m == 1:
                 print("Single tile imaging.")
+
+            mip_jobs = []
+            for m in range(dims.m):  # Loop through each tile
                 for c in range(channels):  # Loop through each channel
-                    max_projected = max_project_z(image, c)  # (y, x)
                     # Clean filename
                     clean_name = f"Base_{cycle}"
-                    filename = f"{clean_name}_s00_C0{c}.tif"
+                    filename = f"{clean_name}_s{m:02d}_C0{c}.tif"
                     output_path = os.path.join(mipped_subfolder, filename)
-
-                    tifffile.imwrite(output_path, max_projected.astype(np.uint16))
-                    print(f"Saved: {output_path}")
-
-            else:
-                for m in range(dims.m):  # Loop through each tile
-                    for c in range(channels):  # Loop through each channel
-                        max_projected = max_project_z(image,m, c)  # (y, x)
-                        # Clean filename
-                        clean_name = f"Base_{cycle}"
-                        filename = f"{clean_name}_s{m:02d}_C0{c}.tif"
-                        output_path = os.path.join(mipped_subfolder, filename)
-
-                        tifffile.imwrite(output_path, max_projected.astype(np.uint16))
-                        print(f"Saved: {output_path}")
+                    if resume and tile_done(output_path, dims.x * dims.y * 2, checksum):
+                        continue
+                    mip_jobs.append((lif_path, index, m, c, output_path, checksum))
+            run_mip_jobs(mip_jobs, n_workers=n_workers, worker=mip_lif_tile)
 
 '''
 This function has been developed around a dataset that is not representative of the typical nd2 format
@@ -0,0 +1,118 @@
+"""
+Compare the previous and the current leica_OME_tiff on a synthetic mipped cycle.
+
+The synthetic cycle follows the layout written by leica_mipping:
+    <root>/mipped/Base_1/Base_1_s<tile>_C0<channel>.tif
+    <root>/mipped/Base_1/MetaData/Region1.xml
+
+Usage:
+    python bench_leica_OME_tiff.py --tiles 100 --channels 5 --size 2048 --workdir /scratch/bench
+
+Note that the default cycle (100 tiles, 5 channels, 2048x2048) is ~4 GB of input TIFFs,
+plus the same again for every OME-TIFF written. Use --size to run a smaller version.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from os.path import join
+
+import numpy as np
+import tifffile
+from tqdm import tqdm
+
+from ISS_processing.preprocessing import leica_OME_tiff, leica_tile_positions
+
+
+def make_synthetic_cycle(root, n_tiles=100, n_channels=5, size=2048, seed=0):
+    """Write a synthetic mipped cycle folder with a Leica TileScanInfo metadata file."""
+    base_dir = join(root, 'mipped', 'Base_1')
+    os.makedirs(join(base_dir, 'MetaData'), exist_ok=True)
+
+    # tiles on a square grid with 10% overlap, positions in meters as in the Leica metadata
+    n_cols = int(np.ceil(np.sqrt(n_tiles)))
+    step = size * 0.9 * .000000321
+    tiles_xml = ''.join(
+        f'<Tile FieldX="{t % n_cols}" FieldY="{t // n_cols}" '
+        f'PosX="{(t % n_cols) * step:.10f}" PosY="{(t // n_cols) * step:.10f}"/>'
+        for t in range(n_tiles))
+    with open(join(base_dir, 'MetaData', 'Region1.xml'), 'w') as f:
+        f.write('<Data><Image><Attachment Name="TileScanInfo">' + tiles_xml + '</Attachment></Image></Data>')
+
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 4096, (size, size), dtype='uint16')
+    for tile in tqdm(range(n_tiles), desc='writing synthetic cycle'):
+        for channel in range(n_channels):
+            tifffile.imwrite(join(base_dir, f'Base_1_s{tile:02d}_C0{channel}.tif'), np.roll(image, tile + channel))
+    return join(root, 'mipped')
+
+
+def leica_OME_tiff_previous(directory_base, output_directory, size=2048):
+    """
+    The stacking loop of leica_OME_tiff before the buffer reuse, kept here as the reference.
+    It allocated a float64 (channels, 2048, 2048) buffer per tile; size only makes it runnable on small tiles.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    for folder in os.listdir(directory_base):
+        exported_directory = join(directory_base, folder)
+        onlytifs = sorted(k for k in os.listdir(exported_directory) if '.tif' in k)
+        tiles = sorted({k.split('_s')[1].split('_')[0] for k in onlytifs}, key=int)
+        channels = sorted({k.split('_s')[1].split('_')[1] for k in onlytifs})
+        meta = [k for k in os.listdir(join(exported_directory, 'MetaData'))][0]
+        positions = np.array(leica_tile_positions(join(exported_directory, 'MetaData', meta))).astype(int)
+
+        with tifffile.TiffWriter(join(output_directory, folder + '.ome.tiff'), bigtiff=True) as tif:
+            for i in range(len(tiles)):
+                position = positions[i]
+                tile_filtered = [k for k in onlytifs if 's' + tiles[i] + '_' in k]
+                stacked = np.empty((len(channels), size, size))
+                for n, image_file in enumerate(sorted(tile_filtered)):
+                    stacked[n] = tifffile.imread(join(exported_directory, image_file)).astype('uint16')
+                metadata = {
+                    'Pixels': {'PhysicalSizeX': 0.1625, 'PhysicalSizeXUnit': 'µm',
+                               'PhysicalSizeY': 0.1625, 'PhysicalSizeYUnit': 'µm'},
+                    'Plane': {'PositionX': [position[0] * 0.1625] * stacked.shape[0],
+                              'PositionY': [position[1] * 0.1625] * stacked.shape[0]}
+                }
+                tif.write(stacked.astype('uint16'), metadata=metadata)
+
+
+def measure(function, *args):
+    """Return wall time (s) and peak traced memory (MB) of function(*args)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiles', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--size', type=int, default=2048, help='Tile size in pixels.')
+    parser.add_argument('--workdir', default=None, help='Scratch directory. Default is a temporary directory.')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_leica_OME_tiff_')
+    try:
+        mipped = make_synthetic_cycle(workdir, args.tiles, args.channels, args.size)
+        results = {}
+        results['previous'] = measure(leica_OME_tiff_previous, mipped, join(workdir, 'OME_previous'), args.size)
+        results['current'] = measure(leica_OME_tiff, mipped, join(workdir, 'OME_current'))
+
+        print(f'\n{args.tiles} tiles x {args.channels} channels, {args.size}x{args.size} px')
+        print(f'{"implementation":<16}{"time (s)":>10}{"peak (MB)":>12}')
+        for name, (elapsed, peak) in results.items():
+            print(f'{name:<16}{elapsed:>10.2f}{peak:>12.1f}')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
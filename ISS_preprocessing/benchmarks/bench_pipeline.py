@@ -0,0 +1,291 @@
+"""
+End-to-end benchmarks of the pipeline functions on synthetic datasets of several sizes.
+
+The suites follow the asv conventions (params, setup, time_* methods) and run offline on the CPU:
+    cd ISS_preprocessing && asv run --python=same
+Without asv, the same benchmarks run once each with:
+    cd ISS_preprocessing && python -m benchmarks.bench_pipeline [name filter] [--sizes small medium]
+
+Synthetic inputs are written once per dataset size to <tempdir>/iss_benchmarks and reused.
+Suites whose dependencies are missing (Ashlar/Java, starfish, ISS_deconvolution) are skipped.
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from os.path import join
+
+from . import synthetic_data
+
+DATASETS = {
+    'small': dict(n_tiles=4, n_cycles=3, n_channels=5, n_z=4, tile_size=256),
+    'medium': dict(n_tiles=16, n_cycles=3, n_channels=5, n_z=4, tile_size=512),
+    'large': dict(n_tiles=36, n_cycles=3, n_channels=5, n_z=4, tile_size=1024),
+}
+DATA_ROOT = join(tempfile.gettempdir(), 'iss_benchmarks')
+
+# Channels are keyed by the number of the synthetic C00-C04 files, i.e. DAPI, Cy3, Cy5, AF750 and AF488
+PSF_METADATA = {
+    'na': 0.8, 'm': 20, 'ni0': 1.0, 'res_lateral': 0.1625, 'res_axial': 1.0,
+    'channels': {'0': {'wavelength': 0.461}, '1': {'wavelength': 0.57}, '2': {'wavelength': 0.67},
+                 '3': {'wavelength': 0.775}, '4': {'wavelength': 0.519}},
+}
+
+
+def synthetic_input(layout, size):
+    """
+    Return the synthetic input of a layout ('autosave', 'lif', 'zen', 'stitched') and dataset size,
+    writing it on first use. Returns the list of cycle folders for 'autosave', of .lif files for
+    'lif', and the folder for 'zen' and 'stitched'.
+    """
+    root = join(DATA_ROOT, f'{layout}_{size}')
+    dataset = synthetic_data.make_dataset(**DATASETS[size])
+    writers = {'autosave': synthetic_data.write_leica_autosave, 'lif': synthetic_data.write_lif,
+               'zen': synthetic_data.write_zen_export, 'stitched': synthetic_data.write_stitched}
+    if not os.path.exists(join(root, 'done')):
+        shutil.rmtree(root, ignore_errors=True)
+        writers[layout](root, dataset)
+        synthetic_data.write_codebook(join(root, 'codebook.csv'), dataset)
+        open(join(root, 'done'), 'w').close()
+    if layout == 'autosave':
+        return [join(root, f'cycle{c + 1}') for c in range(dataset['n_cycles'])]
+    if layout == 'lif':
+        return [join(root, f'Base_{c + 1}.lif') for c in range(dataset['n_cycles'])]
+    return root
+
+
+def import_preprocessing():
+    """
+    Import ISS_processing.preprocessing, raising NotImplementedError to skip the suite if it cannot be imported.
+    It imports Ashlar, whose Java bridge raises a bare Exception when no JDK is found, so any error counts.
+    """
+    try:
+        import ISS_processing.preprocessing as preprocessing
+    except Exception as error:
+        raise NotImplementedError(f'ISS_processing (Ashlar/Java) is not available: {error}')
+    return preprocessing
+
+
+class Benchmark:
+    """Every measurement gets a fresh output folder, so skip-existing logic never shortens a run."""
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 3600
+    params = (list(DATASETS),)
+    param_names = ['size']
+
+    def setup(self, size, *args):
+        self.output = tempfile.mkdtemp(prefix='iss_benchmark_')
+
+    def teardown(self, size, *args):
+        shutil.rmtree(self.output, ignore_errors=True)
+
+
+class LeicaMipping(Benchmark):
+    params = (list(DATASETS), [1, 4])
+    param_names = ['size', 'n_workers']
+
+    def setup(self, size, n_workers):
+        self.leica_mipping = import_preprocessing().leica_mipping
+        self.input_dirs = synthetic_input('autosave', size)
+        self.image_dimension = [DATASETS[size]['tile_size']] * 2
+        super().setup(size)
+
+    def time_leica_mipping(self, size, n_workers):
+        self.leica_mipping(self.input_dirs, join(self.output, 'out'), image_dimension=self.image_dimension,
+                           n_workers=n_workers)
+
+    def time_leica_mipping_fused(self, size, n_workers):
+        self.leica_mipping(self.input_dirs, join(self.output, 'out'), image_dimension=self.image_dimension,
+                           n_workers=n_workers, ome_tiff=True, write_mipped=False)
+
+
+class LeicaOMETiff(Benchmark):
+    def setup(self, size):
+        preprocessing = import_preprocessing()
+        self.leica_OME_tiff = preprocessing.leica_OME_tiff
+        self.mipped = join(DATA_ROOT, f'mipped_{size}')
+        if not os.path.exists(join(self.mipped, 'done')):
+            preprocessing.leica_mipping(synthetic_input('autosave', size), self.mipped,
+                          image_dimension=[DATASETS[size]['tile_size']] * 2)
+            open(join(self.mipped, 'done'), 'w').close()
+        super().setup(size)
+
+    def time_leica_OME_tiff(self, size):
+        self.leica_OME_tiff(join(self.mipped, 'preprocessing', 'mipped'), self.output)
+
+    def time_leica_OME_tiff_zstd(self, size):
+        self.leica_OME_tiff(join(self.mipped, 'preprocessing', 'mipped'), self.output,
+                            tile=(256, 256), compression='zstd')
+
+
+class LifMipping(Benchmark):
+    def setup(self, size):
+        self.lif_mipping = import_preprocessing().lif_mipping
+        self.lif_files = synthetic_input('lif', size)
+        super().setup(size)
+
+    def time_lif_mipping(self, size):
+        for cycle, lif_file in enumerate(self.lif_files, start=1):
+            self.lif_mipping(lif_file, self.output, cycle)
+
+
+class ZenOMETiff(Benchmark):
+    def setup(self, size):
+        self.zen_OME_tiff = import_preprocessing().zen_OME_tiff
+        self.exported = synthetic_input('zen', size)
+        super().setup(size)
+
+    def time_zen_OME_tiff(self, size):
+        self.zen_OME_tiff(self.exported, self.output)
+
+
+class Ashlar(Benchmark):
+    def setup(self, size):
+        preprocessing = import_preprocessing()
+        self.ashlar_wrapper = preprocessing.ashlar_wrapper
+        self.OME_tiffs = join(DATA_ROOT, f'zen_OME_tiffs_{size}')
+        if not os.path.exists(join(self.OME_tiffs, 'done')):
+            preprocessing.zen_OME_tiff(synthetic_input('zen', size), self.OME_tiffs)
+            open(join(self.OME_tiffs, 'done'), 'w').close()
+        super().setup(size)
+
+    def time_ashlar_wrapper(self, size):
+        files = sorted(join(self.OME_tiffs, f) for f in os.listdir(self.OME_tiffs) if f.endswith('.ome.tif'))
+        self.ashlar_wrapper(files=files, output=self.output, align_channel=0)
+
+
+class Retiling(Benchmark):
+    params = (list(DATASETS), ['tif', 'zarr'])
+    param_names = ['size', 'output_format']
+
+    def setup(self, size, output_format):
+        self.tile_stitched_images = import_preprocessing().tile_stitched_images
+        if output_format == 'zarr':
+            try:
+                import zarr
+            except ImportError:
+                raise NotImplementedError('zarr is not available')
+        self.stitched = synthetic_input('stitched', size)
+        self.tile_dim = DATASETS[size]['tile_size']
+        super().setup(size)
+
+    def time_tile_stitched_images(self, size, output_format):
+        self.tile_stitched_images(self.stitched, self.output, tile_dim=self.tile_dim, output_format=output_format)
+
+
+class SpaceTxFormat(Benchmark):
+    def setup(self, size):
+        try:
+            from ISS_decoding.SpaceTx_format import make_spacetx_format
+        except ImportError:
+            raise NotImplementedError('ISS_decoding (starfish) is not available')
+        tile_stitched_images = import_preprocessing().tile_stitched_images
+        self.make_spacetx_format = make_spacetx_format
+        self.tile_dim = DATASETS[size]['tile_size']
+        self.section = join(DATA_ROOT, f'section_{size}')
+        if not os.path.exists(join(self.section, 'done')):
+            stitched = synthetic_input('stitched', size)
+            tile_stitched_images(stitched, join(self.section, 'preprocessing', 'ReslicedTiles'), tile_dim=self.tile_dim)
+            open(join(self.section, 'done'), 'w').close()
+        self.codebook = join(synthetic_input('stitched', size), 'codebook.csv')
+        super().setup(size)
+
+    def time_make_spacetx_format(self, size):
+        self.make_spacetx_format(self.section, self.codebook,
+                                 filenames=[f'Base_{c + 1}_stitched' for c in range(DATASETS[size]['n_cycles'])],
+                                 tile_dim=self.tile_dim, folder_spacetx=os.path.relpath(self.output, self.section))
+
+
+class Deconvolution(Benchmark):
+    params = (list(DATASETS), ['redlionfish', 'native', 'native_accelerated'], [None, 0.999], [None, 256])
+    param_names = ['size', 'method', 'psf_energy', 'chunk_size']
+
+    def setup(self, size, method, psf_energy, chunk_size):
+        try:
+            from ISS_deconvolution.deconvolution import deconvolve_leica
+        except Exception as error:
+            # RedLionfish can fail on more than a missing module, e.g. without an OpenCL platform
+            raise NotImplementedError(f'ISS_deconvolution is not available: {error}')
+        self.deconvolve_leica = deconvolve_leica
+        self.input_dirs = synthetic_input('autosave', size)
+        self.image_dimensions = [DATASETS[size]['tile_size']] * 2
+        super().setup(size)
+
+    def time_deconvolve_leica(self, size, method, psf_energy, chunk_size):
+        accelerate = method.endswith('_accelerated')
+        self.deconvolve_leica(self.input_dirs[0], join(self.output, 'out'), 1,
+                              deconvolution_method=method.replace('_accelerated', ''),
+                              PSF_metadata=PSF_METADATA, mode='tif_autosaved',
+                              image_dimensions=self.image_dimensions, chunk_size=chunk_size, psf_energy=psf_energy,
+                              niter=20 if accelerate else None, accelerate=accelerate)
+
+    def peakmem_deconvolve_leica(self, size, method, psf_energy, chunk_size):
+        self.time_deconvolve_leica(size, method, psf_energy, chunk_size)
+
+
+class GibsonLanniPSF(Benchmark):
+    params = (list(DATASETS), ['generate', 'disk_cache'])
+    param_names = ['size', 'method']
+
+    def setup(self, size, method):
+        try:
+            from ISS_deconvolution import psf
+        except Exception as error:
+            # RedLionfish can fail on more than a missing module, e.g. without an OpenCL platform
+            raise NotImplementedError(f'ISS_deconvolution is not available: {error}')
+        self.psf = psf.GibsonLanni(na=PSF_METADATA['na'], m=PSF_METADATA['m'], ni0=PSF_METADATA['ni0'],
+                                   res_lateral=PSF_METADATA['res_lateral'], res_axial=PSF_METADATA['res_axial'],
+                                   wavelength=PSF_METADATA['channels']['1']['wavelength'],
+                                   size_x=DATASETS[size]['tile_size'], size_y=DATASETS[size]['tile_size'],
+                                   size_z=DATASETS[size]['n_z'])
+        super().setup(size)
+        if method == 'disk_cache':
+            self.psf.generate_cached(cache_dir=self.output)
+            psf.PSF_MEMORY_CACHE.clear()
+
+    def time_psf(self, size, method):
+        if method == 'generate':
+            self.psf.generate(dtype='float32')
+        else:
+            self.psf.generate_cached(cache_dir=self.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run every benchmark once, without asv.')
+    parser.add_argument('filter', nargs='?', default='', help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(DATASETS))
+    args = parser.parse_args()
+
+    results = []
+    for suite in Benchmark.__subclasses__():
+        for name in sorted(n for n in dir(suite) if n.startswith('time_')):
+            label = f'{suite.__name__}.{name}'
+            if args.filter not in label:
+                continue
+            grid = [[p for p in values if p in args.sizes] if i == 0 else values
+                    for i, values in enumerate(suite.params)]
+            for params in itertools.product(*grid):
+                benchmark = suite()
+                try:
+                    benchmark.setup(*params)
+                except NotImplementedError as skipped:
+                    results.append((label, params, f'skipped: {skipped}'))
+                    break
+                try:
+                    start = time.perf_counter()
+                    getattr(benchmark, name)(*params)
+                    results.append((label, params, f'{time.perf_counter() - start:.2f} s'))
+                finally:
+                    benchmark.teardown(*params)
+
+    print()
+    for label, params, result in results:
+        print(f'{label:<48}{str(params):<24}{result}')
+
+
+if __name__ == '__main__':
+    main()
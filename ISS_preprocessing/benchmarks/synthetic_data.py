@@ -0,0 +1,280 @@
+"""
+Synthetic ISS datasets for benchmarking, with known spot positions and codebook barcodes.
+
+A dataset is a grid of overlapping tiles cut from a virtual mosaic. Every spot belongs to a gene of
+the codebook and lights up, in every cycle, the channel given by the gene's barcode for that cycle.
+Channel 0 holds nuclei. The writers lay the data out as the pipeline expects it:
+
+- write_leica_autosave: Leica autosave z-planes, input of leica_mipping and deconvolve_tif (mode 'tif_autosaved').
+- write_lif: one .lif file per cycle, input of lif_mipping and deconvolve_lif.
+- write_zen_export: projected ZEN tiles with the info.xml written by process_czi, input of zen_OME_tiff.
+  CZI files themselves cannot be written without Zeiss' libraries, so this is the CZI-like layout.
+- write_stitched: stitched mosaics named as ashlar_wrapper names them, input of tile_stitched_images.
+- write_codebook: codebook csv as read by make_spacetx_format.
+
+Everything runs offline on the CPU, e.g.:
+    dataset = make_dataset(n_tiles=16, n_cycles=5, tile_size=512)
+    input_dirs = write_leica_autosave('/tmp/synthetic', dataset)
+"""
+import os
+import struct
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+# Leica stage positions are stored in meters, leica_tile_positions converts them with this pixel size.
+METERS_PER_PIXEL = .000000321
+
+# Image channel of barcode codes 1-4, for the default channels ["DAPI", "Cy3", "Cy5", "AF750", "AF488"]
+# and DO_decorators ["AF750", "Cy5", "Cy3", "AF488"] of make_spacetx_format.
+CODE_CHANNELS = (3, 2, 1, 4)
+
+
+def make_dataset(n_tiles=4, n_cycles=5, n_channels=5, n_z=4, tile_size=256, n_genes=20, spots_per_tile=50,
+                 overlap=0.1, code_channels=CODE_CHANNELS, seed=0):
+    """
+    Draw the codebook, spot positions and tile layout of a synthetic dataset.
+
+    Parameters:
+    - n_tiles: Number of tiles, laid out on a square grid row by row.
+    - n_cycles: Number of sequencing cycles, i.e. barcode length.
+    - n_channels: Number of channels. Channel 0 holds nuclei, the code_channels hold spots.
+    - n_z: Number of z-planes. Every spot is in focus in one plane.
+    - tile_size: Tile size in pixels.
+    - n_genes: Number of genes in the codebook.
+    - spots_per_tile: Average number of spots per tile.
+    - overlap: Fraction of the tile size shared by neighbouring tiles.
+    - code_channels: Image channel of every barcode code (codes are 1-based).
+    - seed: Seed of the random generator.
+
+    Returns:
+    - Dictionary with the codebook (DataFrame gene, cycle_1, ...), the spots (DataFrame gene, x, y, z
+      in mosaic pixels), the nuclei (DataFrame x, y), the tile positions ((n_tiles, 2) array of x, y
+      in pixels), the mosaic shape and the parameters above.
+    """
+    rng = np.random.default_rng(seed)
+    n_codes = len(code_channels)
+    if n_genes > n_codes ** n_cycles:
+        raise ValueError(f'{n_cycles} cycles with {n_codes} codes only give {n_codes ** n_cycles} barcodes.')
+    barcodes = set()
+    while len(barcodes) < n_genes:
+        barcodes.add(tuple(rng.integers(1, n_codes + 1, n_cycles)))
+    codebook = pd.DataFrame(sorted(barcodes), columns=[f'cycle_{c + 1}' for c in range(n_cycles)])
+    codebook.insert(0, 'gene', [f'gene_{g + 1}' for g in range(n_genes)])
+
+    n_cols = int(np.ceil(np.sqrt(n_tiles)))
+    n_rows = int(np.ceil(n_tiles / n_cols))
+    step = int(round(tile_size * (1 - overlap)))
+    positions = np.array([((t % n_cols) * step, (t // n_cols) * step) for t in range(n_tiles)])
+    mosaic_shape = ((n_rows - 1) * step + tile_size, (n_cols - 1) * step + tile_size)
+
+    n_spots = spots_per_tile * n_tiles
+    spots = pd.DataFrame({
+        'gene': codebook['gene'].values[rng.integers(0, n_genes, n_spots)],
+        'x': rng.uniform(0, mosaic_shape[1], n_spots),
+        'y': rng.uniform(0, mosaic_shape[0], n_spots),
+        'z': rng.integers(0, n_z, n_spots),
+    })
+    n_nuclei = max(1, int(mosaic_shape[0] * mosaic_shape[1] / (tile_size / 4) ** 2))
+    nuclei = pd.DataFrame({'x': rng.uniform(0, mosaic_shape[1], n_nuclei),
+                           'y': rng.uniform(0, mosaic_shape[0], n_nuclei)})
+
+    return {'codebook': codebook, 'spots': spots, 'nuclei': nuclei, 'positions': positions,
+            'mosaic_shape': mosaic_shape, 'n_tiles': n_tiles, 'n_cycles': n_cycles, 'n_channels': n_channels,
+            'n_z': n_z, 'tile_size': tile_size, 'code_channels': tuple(code_channels), 'seed': seed}
+
+
+def add_blobs(planes, xs, ys, zs, sigma, amplitude, z_sigma=1.0):
+    """Add Gaussian blobs at (xs, ys) in plane coordinates, in focus at planes zs (None: all planes)."""
+    n_z, height, width = planes.shape
+    radius = int(np.ceil(3 * sigma))
+    offsets = np.arange(-radius, radius + 1)
+    for x, y, z in zip(xs, ys, zs):
+        cx, cy = int(round(x)), int(round(y))
+        y0, y1 = max(cy - radius, 0), min(cy + radius + 1, height)
+        x0, x1 = max(cx - radius, 0), min(cx + radius + 1, width)
+        if y0 >= y1 or x0 >= x1:
+            continue
+        gy = np.exp(-((offsets[y0 - cy + radius:y1 - cy + radius] + cy - y) ** 2) / (2 * sigma ** 2))
+        gx = np.exp(-((offsets[x0 - cx + radius:x1 - cx + radius] + cx - x) ** 2) / (2 * sigma ** 2))
+        blob = amplitude * np.outer(gy, gx)
+        for plane in range(n_z):
+            focus = 1.0 if z is None else np.exp(-((plane - z) ** 2) / (2 * z_sigma ** 2))
+            planes[plane, y0:y1, x0:x1] += blob * focus
+
+
+def render_tile(dataset, cycle, tile):
+    """
+    Render one tile of one cycle (0-based) as a (channels, z, y, x) uint16 array.
+    """
+    size = dataset['tile_size']
+    x0, y0 = dataset['positions'][tile]
+    rng = np.random.default_rng((dataset['seed'], cycle, tile))
+    planes = rng.normal(100, 10, (dataset['n_channels'], dataset['n_z'], size, size)).astype('float32')
+
+    margin = 10
+    nuclei = dataset['nuclei']
+    inside = nuclei['x'].between(x0 - 6 * margin, x0 + size + 6 * margin) & \
+        nuclei['y'].between(y0 - 6 * margin, y0 + size + 6 * margin)
+    add_blobs(planes[0], nuclei['x'][inside] - x0, nuclei['y'][inside] - y0, [None] * inside.sum(),
+              sigma=size / 40 + 2, amplitude=2000)
+
+    spots = dataset['spots']
+    inside = spots['x'].between(x0 - margin, x0 + size + margin) & spots['y'].between(y0 - margin, y0 + size + margin)
+    spots = spots[inside]
+    codes = dataset['codebook'].set_index('gene')[f'cycle_{cycle + 1}']
+    channels = np.array(dataset['code_channels'])[codes.loc[spots['gene']].values - 1]
+    for channel in np.unique(channels):
+        if channel >= dataset['n_channels']:
+            continue
+        selected = spots[channels == channel]
+        add_blobs(planes[channel], selected['x'] - x0, selected['y'] - y0, selected['z'], sigma=1.5, amplitude=3000)
+
+    return np.clip(planes, 0, 65535).astype('uint16')
+
+
+def tile_xml(dataset):
+    """Leica TileScanInfo attachment of the tile positions, as read by leica_tile_positions."""
+    step = dataset['positions'][1][0] if dataset['n_tiles'] > 1 else 1
+    return ''.join(
+        f'<Tile FieldX="{x // max(step, 1)}" FieldY="{y // max(step, 1)}" '
+        f'PosX="{x * METERS_PER_PIXEL:.10f}" PosY="{y * METERS_PER_PIXEL:.10f}"/>'
+        for x, y in dataset['positions'])
+
+
+def write_leica_autosave(root, dataset, region='Region1_Merged'):
+    """
+    Write every cycle as a Leica autosave folder, <root>/cycle<n>, with
+    <region>--Stage<tile>--Z<z>--C<channel>.tif z-planes and Metadata/<region>.xml.
+
+    Returns:
+    - The list of cycle folders, in cycle order, to pass to leica_mipping as input_dirs.
+    """
+    digits = max(2, len(str(dataset['n_tiles'] - 1)))
+    input_dirs = []
+    for cycle in range(dataset['n_cycles']):
+        cycle_dir = join(root, f'cycle{cycle + 1}')
+        os.makedirs(join(cycle_dir, 'Metadata'), exist_ok=True)
+        with open(join(cycle_dir, 'Metadata', region + '.xml'), 'w') as f:
+            f.write('<Data><Image><Attachment Name="TileScanInfo">' + tile_xml(dataset) + '</Attachment></Image></Data>')
+        for tile in range(dataset['n_tiles']):
+            stack = render_tile(dataset, cycle, tile)
+            for channel in range(stack.shape[0]):
+                for z in range(stack.shape[1]):
+                    tifffile.imwrite(join(cycle_dir, f'{region}--Stage{tile:0{digits}d}--Z{z:02d}--C{channel:02d}.tif'),
+                                     stack[channel, z])
+        input_dirs.append(cycle_dir)
+    return input_dirs
+
+
+def lif_block_header(block_size, description):
+    """Header of a LIF memory block: magic, memory byte, 64-bit block size, memory byte, UTF-16 description."""
+    description = description.encode('utf-16-le')
+    return (struct.pack('<Ii', 0x70, 0) + b'\x2a' + struct.pack('<Q', block_size) + b'\x2a'
+            + struct.pack('<I', len(description) // 2) + description)
+
+
+def write_lif(root, dataset, name='Region1'):
+    """
+    Write every cycle as one Leica .lif file, <root>/Base_<n>.lif, holding a single mosaic image
+    (x, y, z, channel, tile) with 16-bit channels and a TileScanInfo attachment, readable by readlif.
+
+    Returns:
+    - The list of .lif files, in cycle order.
+    """
+    os.makedirs(root, exist_ok=True)
+    size, n_z, n_channels, n_tiles = dataset['tile_size'], dataset['n_z'], dataset['n_channels'], dataset['n_tiles']
+    plane_bytes = size * size * 2
+    channels = ''.join(f'<ChannelDescription DataType="0" ChannelTag="0" Resolution="16" Min="0" Max="65535" '
+                       f'Unit="" LUTName="Gray" IsLUTInverted="0" BytesInc="{c * plane_bytes}"/>'
+                       for c in range(n_channels))
+    length = size * METERS_PER_PIXEL
+    dimensions = (f'<DimensionDescription DimID="1" NumberOfElements="{size}" Origin="0" Length="{length}" Unit="m" BytesInc="2"/>'
+                  f'<DimensionDescription DimID="2" NumberOfElements="{size}" Origin="0" Length="{length}" Unit="m" BytesInc="{size * 2}"/>'
+                  f'<DimensionDescription DimID="3" NumberOfElements="{n_z}" Origin="0" Length="{n_z * 1e-6}" Unit="m" BytesInc="{n_channels * plane_bytes}"/>'
+                  f'<DimensionDescription DimID="10" NumberOfElements="{n_tiles}" Origin="0" Length="0" Unit="" BytesInc="{n_z * n_channels * plane_bytes}"/>')
+    image_size = n_tiles * n_z * n_channels * plane_bytes
+
+    lif_files = []
+    for cycle in range(dataset['n_cycles']):
+        xml = ('<LMSDataContainerHeader Version="2"><Element Name="Base_{0}"><Data><Experiment/></Data><Children>'
+               '<Element Name="{1}"><Data><Image><ImageDescription><Channels>{2}</Channels>'
+               '<Dimensions>{3}</Dimensions></ImageDescription>'
+               '<Attachment Name="TileScanInfo" Application="LAS AF" FlipX="0" FlipY="0" SwapXY="0">{4}</Attachment>'
+               '</Image></Data><Memory Size="{5}" MemoryBlockID="MemBlock_1"/><Children/></Element>'
+               '</Children></Element></LMSDataContainerHeader>').format(
+            cycle + 1, name, channels, dimensions, tile_xml(dataset), image_size)
+        xml = xml.encode('utf-16-le')
+
+        lif_file = join(root, f'Base_{cycle + 1}.lif')
+        with open(lif_file, 'wb') as f:
+            f.write(struct.pack('<Ii', 0x70, 0) + b'\x2a' + struct.pack('<I', len(xml) // 2) + xml)
+            # the image block, with the planes tile by tile, z by z, channel by channel
+            f.write(lif_block_header(image_size, 'MemBlock_1'))
+            for tile in range(n_tiles):
+                stack = render_tile(dataset, cycle, tile)
+                f.write(np.ascontiguousarray(stack.transpose(1, 0, 2, 3)).tobytes())
+        lif_files.append(lif_file)
+    return lif_files
+
+
+def write_zen_export(root, dataset):
+    """
+    Write the maximum projections of every cycle as process_czi exports them:
+    Base_<cycle>_c<channel>m<tile>_ORG.tif (1-based) and Base_<cycle>_info.xml with the tile bounds.
+
+    Returns:
+    - root, to pass to zen_OME_tiff as exported_directory.
+    """
+    os.makedirs(root, exist_ok=True)
+    size = dataset['tile_size']
+    for cycle in range(dataset['n_cycles']):
+        images = []
+        for tile in range(dataset['n_tiles']):
+            mip = render_tile(dataset, cycle, tile).max(axis=1)
+            n = f'{tile + 1:02d}'
+            for channel in range(mip.shape[0]):
+                filename = f'Base_{cycle + 1}_c{channel + 1}m{n}_ORG.tif'
+                tifffile.imwrite(join(root, filename), mip[channel])
+                images.append((channel, tile, filename))
+        x, y = dataset['positions'][:, 0], dataset['positions'][:, 1]
+        xml = ''.join(
+            f'<Image><Filename>{filename}</Filename><Bounds StartX="{x[tile]}" SizeX="{size}" StartY="{y[tile]}" '
+            f'SizeY="{size}" StartZ="0" StartC="0" StartM="{tile}"/><Zoom>1</Zoom></Image>'
+            for channel, tile, filename in sorted(images))
+        with open(join(root, f'Base_{cycle + 1}_info.xml'), 'w') as f:
+            f.write('<ExportDocument>' + xml + '</ExportDocument>')
+    return root
+
+
+def write_stitched(root, dataset):
+    """
+    Write the stitched mosaics of every cycle and channel as ashlar_wrapper names them,
+    Round<cycle>_<channel>.tif (0-based), maximum projected over z.
+
+    Returns:
+    - root, to pass to tile_stitched_images as image_path.
+    """
+    os.makedirs(root, exist_ok=True)
+    size = dataset['tile_size']
+    for cycle in range(dataset['n_cycles']):
+        mosaic = np.zeros((dataset['n_channels'], *dataset['mosaic_shape']), dtype='uint16')
+        for tile, (x, y) in enumerate(dataset['positions']):
+            mosaic[:, y:y + size, x:x + size] = render_tile(dataset, cycle, tile).max(axis=1)
+        for channel in range(mosaic.shape[0]):
+            tifffile.imwrite(join(root, f'Round{cycle}_{channel}.tif'), mosaic[channel])
+    return root
+
+
+def write_codebook(path, dataset):
+    """Write the codebook as make_spacetx_format reads it: gene,code_cycle_1,code_cycle_2,... without header."""
+    dataset['codebook'].to_csv(path, header=False, index=False)
+    return path
+
+
+def write_spots(path, dataset):
+    """Write the ground truth spots (gene, x, y, z in mosaic pixels) to a csv file."""
+    dataset['spots'].to_csv(path, index=False)
+    return path